@@ -1,60 +1,131 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+import flask
 
-import pandas as pd
-import plotly.express as px
-import re
+import gc
+import logging
+import os
+import urllib.parse
 
-from functions import filterByTokens
+import plotly.express as px
 
-# load article csv into panda
+from cache import ResultCache
+from corpus import CorpusCache, detailLimit, findCorpora, relatedLimit
+from metrics import instrument, logger, observeSelection, phase, registerEndpoints
+from functions import getBarTemplate, getSearchTerms, getSelection, statisticsPageSize, statisticsViews
 
-articleData = pd.read_csv('fataburen_articles_diva_processed.csv')
+# Corpora are loaded on first use: the Fataburen data in this directory, and every directory
+# prepared with prepare_data.py --directory in FATABUREN_CORPORA_DIR, served at /<corpus>/...
 
-articleData['Pages'] = articleData['EndPage']-articleData['StartPage']+1  # add pagecount as separate column in dataframe
+defaultCorpus = os.environ.get('FATABUREN_CORPUS', 'fataburen')
+corpora = CorpusCache(
+    findCorpora(defaultCorpus, '.', os.environ.get('FATABUREN_CORPORA_DIR', 'corpora')),
+    float(os.environ.get('FATABUREN_MEMORY_BUDGET_MB', 1024))*2**20)
 
-articleData = articleData[articleData['NBN'].str.contains('nordiskamuseet')]  # clean data by removing duplicate articles added by other institutions
+# Corpora named in FATABUREN_PRELOAD (comma separated) are loaded at import. With gunicorn --preload
+# this happens once before the workers are forked, and the workers share the loaded arrays
+# copy-on-write instead of each loading its own copy.
 
-# Load & prepare author data
+preloadCorpora = [name.strip() for name in os.environ.get('FATABUREN_PRELOAD', '').split(',') if name.strip()]
+for corpusName in preloadCorpora:
+    corpora.get(corpusName)
+if preloadCorpora:
+    gc.freeze()  # keep the garbage collector from writing to (and so copying) the pages of preloaded objects
 
-authorsData = pd.read_csv('fataburen_authors.csv')
-unique_authors = authorsData['Name']
 
-authorsDataByArticleCount = authorsData.copy()
-authorsDataByPageCount = authorsData.copy()
-authorsDataByEarliestArticle = authorsData.copy()
+def getRoute(pathname):
+    # '/<corpus>/<page>' or '/<page>' (default corpus) -> corpus name, page
+    parts = (pathname or '/').strip('/').split('/')
+    if parts[0] in corpora.directories:
+        return parts[0], parts[1] if len(parts) > 1 else ''
+    return defaultCorpus, parts[0]
 
-authorsDataByArticleCount.sort_values(by=['ArticlesTotal', 'Name'], ascending=[True, False], inplace=True)
-authorsDataByPageCount.sort_values(by=['PagesTotal', 'Name'], ascending=[True, False], inplace=True)
-authorsDataByEarliestArticle.sort_values(by=['EarliestArticle', 'Name'], ascending=[False, False], inplace=True)
-authorsDataByEarliestArticle['LatestArticleYear'] = authorsDataByEarliestArticle['LatestArticle'].str.slice(0, 4)
-authorsDataByEarliestArticle['ArticleMeanRounded'] = round(authorsDataByEarliestArticle['ArticleMean'], 0)
 
-# Load & prepare keyword data
+def getCorpus(name):
+    corpus = corpora.get(name)
+    if corpus is None:
+        raise PreventUpdate
+    return corpus
 
-keywordsData = pd.read_csv('fataburen_keywords.csv')
-unique_keywords = keywordsData['Keyword'].unique()
 
-keywordsDataByArticleCount = keywordsData.copy()
-keywordsDataByPageCount = keywordsData.copy()
-keywordsDataByEarliestArticle = keywordsData.copy()
+barTemplate = getBarTemplate()  # Explore figures only send the bar chart part of the plotly template
 
-keywordsDataByArticleCount.sort_values(by=['ArticlesTotal', 'Keyword'], ascending=[True, False], inplace=True)
-keywordsDataByPageCount.sort_values(by=['PagesTotal', 'Keyword'], ascending=[True, False], inplace=True)
-keywordsDataByEarliestArticle.sort_values(by=['EarliestArticle', 'Keyword'], ascending=[False, False], inplace=True)
-keywordsDataByEarliestArticle['LatestArticleYear'] = keywordsDataByEarliestArticle['LatestArticle'].str.slice(0, 4)
-keywordsDataByEarliestArticle['ArticleMeanRounded'] = round(keywordsDataByEarliestArticle['ArticleMean'], 0)
+# Cache for Explore results, keyed on the corpus and the normalized selection. Set
+# FATABUREN_CACHE_DIR to share results between gunicorn workers through a directory.
 
-unique_keywords = keywordsData['Keyword']
+graphCache = ResultCache(int(os.environ.get('FATABUREN_CACHE_SIZE', 256)), os.environ.get('FATABUREN_CACHE_DIR'))
 
 # Initiate & configure Dash to display the graphs
 
+logging.basicConfig(level=os.environ.get('FATABUREN_LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
 app = dash.Dash(__name__, suppress_callback_exceptions=True)
 
 server = app.server
 
+
+@server.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify(graphCache.stats())
+
+
+@server.route('/corpus-stats')
+def corpus_stats():
+    return flask.jsonify(corpora.stats())
+
+
+registerEndpoints(server, graphCache.stats)  # /metrics
+
+# Export of the articles (or their authors/keywords) matching an Explore selection, e.g.
+# /fataburen/export/articles.csv?keyword=Folktro&keyword=Julseder&author=...&q=...&from=1900&to=1950
+# The rows are rendered and sent exportChunkSize at a time, so a large export is never held in memory.
+
+exportChunkSize = 1000
+exportFormats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+exportColumns = {'articles': None, 'authors': 'Name', 'keywords': 'Keywords'}
+
+
+def getExportChunks(data, fileFormat, rows=None):
+    # csv (with header) or ndjson text of data, exportChunkSize rows at a time; rows are row positions
+    # in data, all rows when None
+    count = len(data) if rows is None else len(rows)
+    if fileFormat == 'csv':
+        yield data.iloc[0:0].to_csv(index=False)
+    for start in range(0, count, exportChunkSize):
+        chunk = data.iloc[start:start+exportChunkSize] if rows is None else data.iloc[rows[start:start+exportChunkSize]]
+        if fileFormat == 'csv':
+            yield chunk.to_csv(header=False, index=False)
+        else:
+            yield chunk.to_json(orient='records', lines=True, force_ascii=False).rstrip('\n') + '\n'
+
+
+@server.route('/export/<kind>.<file_format>', defaults={'corpus_name': None})
+@server.route('/<corpus_name>/export/<kind>.<file_format>')
+def export_selection(corpus_name, kind, file_format):
+    corpus = corpora.get(corpus_name or defaultCorpus)
+    if corpus is None or kind not in exportColumns or file_format not in exportFormats:
+        flask.abort(404)
+    arguments = flask.request.args
+    try:
+        yearRange = corpus.getYearRange([int(arguments.get('from', corpus.firstYear)), int(arguments.get('to', corpus.lastYear))])
+    except ValueError:
+        flask.abort(400)
+    keywords = getSelection(arguments.getlist('keyword'), None)
+    authors = getSelection(arguments.getlist('author'), None)
+    logger.info('Export of %s: keywords: %s, authors: %s, search: %s, years: %s', kind, keywords if keywords else 'None', authors if authors else 'None', arguments.get('q') or 'None', yearRange if yearRange else 'All')
+
+    selectedRows = corpus.selectArticles(keywords, authors, arguments.get('q'), yearRange)[0]
+    if kind == 'articles':
+        chunks = getExportChunks(corpus.articleData, file_format, selectedRows)
+    else:
+        chunks = getExportChunks(corpus.getSelectionTotals(exportColumns[kind], selectedRows), file_format)
+    response = flask.Response(chunks, mimetype=exportFormats[file_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=' + corpus.name + '_' + kind + '.' + file_format
+    return response
+
 # Layouts
 
 url_bar_and_content_div = html.Div([
@@ -62,306 +133,350 @@ url_bar_and_content_div = html.Div([
     html.Div(id='page-content')
 ])
 
-header = html.Div(children=[
-    html.H1('Fataburen Articles 1886–2017'),
-    dcc.Link('Explore Articles', href='/explore'), ' • Article Statistics: ',
-    dcc.Link('Authors by Article Count', href='/authors-articles'), ' • ',
-    dcc.Link('Authors by Page Count', href='/authors-pages'), ' • ',
-    dcc.Link('Authors by Active Period', href='/authors-period'), ' • ',
-    dcc.Link('Keywords by Author', href='/keywords-author'), ' • ',
-    dcc.Link('Keywords by Article Count', href='/keywords-articles'), ' • ',
-    dcc.Link('Keywords by Page Count', href='/keywords-pages'), ' • ',
-    dcc.Link('Keywords by Active Period', href='/keywords-period'), ' • ',
-    dcc.Link('About', href='/about'),
-    ],
-    id='header'
-)
-
-layout_explore = html.Div(children=[
-    header,
-    html.P([
-        'Explore the content of Fataburen, the yearbook/journal of Nordiska museet & Skansen. Work in progress by ',
-        html.A(
-            children='Aron Ambrosiani',
-            href='https://twitter.com/AronAmbrosiani/'
-            ),
-        '. ',
-        dcc.Link('About this website', href='/about')
-        ]),
-    html.Div(
-        className='dropdowns',
-        children=[
-            dcc.Dropdown(
-                id='keyword',
-                options=[{'label': i, 'value': i} for i in unique_keywords],
-                value='Keywords',
-                multi=True,
-                placeholder='Select keywords (OR)'
-            ),
-            dcc.Dropdown(
-                id='author',
-                options=[{'label': i, 'value': i} for i in unique_authors],
-                value='Name',
-                multi=True,
-                placeholder='Select authors (OR)'
-            )
-        ]
-    ),
-    html.P(
-        id='articleCount',
-        children=''),
-    dcc.Graph(
-        id='articlesByYearFigure'
-    ),
-    html.Div([
-        html.H2(
-            children='Selected Article: '
-        ),
+def getHeader(corpus):
+    prefix = '/' + corpus.name + '/'
+    return html.Div(children=[
+        dcc.Store(id='corpus', data=corpus.name),
+        html.H1(corpus.title),
+        dcc.Link('Explore Articles', href=prefix+'explore'), ' • Article Statistics: ',
+        dcc.Link('Authors by Article Count', href=prefix+'authors-articles'), ' • ',
+        dcc.Link('Authors by Page Count', href=prefix+'authors-pages'), ' • ',
+        dcc.Link('Authors by Active Period', href=prefix+'authors-period'), ' • ',
+        dcc.Link('Keywords by Author', href=prefix+'keywords-author'), ' • ',
+        dcc.Link('Keywords by Article Count', href=prefix+'keywords-articles'), ' • ',
+        dcc.Link('Keywords by Page Count', href=prefix+'keywords-pages'), ' • ',
+        dcc.Link('Keywords by Active Period', href=prefix+'keywords-period'), ' • ',
+        dcc.Link('Related Keywords', href=prefix+'related-keywords'), ' • ',
+        dcc.Link('Trends', href=prefix+'trends'), ' • ',
+        dcc.Link('About', href=prefix+'about'),
+        ],
+        id='header'
+    )
+
+
+def getExploreLayout(corpus):
+    return html.Div(children=[
+        getHeader(corpus),
         html.P([
-            html.Span(
-                id='articleInfo',
-                children=''
-                ),
-            html.Br(),
-            'Link to DiVA page: ',
+            corpus.description + ' Work in progress by ',
             html.A(
-                id='outbound-link',
-                href='',
-                target='_blank',
-                children='',
-                title=''),
-            html.Br(),
-            'Direct link to PDF: ',
-            html.A(
-                id='pdf-link',
-                href='',
-                target='_blank',
-                children='',
-                title='')
-        ])], className='one column'
-    )])
-
-layout_authors_articles = html.Div(children=[
-    header,
-    html.Div(
-        dcc.Graph(
-            id='authorsByArticles',
-            figure=px.bar(
-                authorsDataByArticleCount,
-                x='ArticlesTotal',
-                y='Name',
-                orientation='h',
-                title='Authors by Article Count',
-                hover_name='Name',
-                hover_data={'Name': False}
-            ),
-            style={'height': len(authorsDataByArticleCount)*15},
+                children='Aron Ambrosiani',
+                href='https://twitter.com/AronAmbrosiani/'
+                ),
+            '. ',
+            dcc.Link('About this website', href='/' + corpus.name + '/about')
+            ]),
+        html.Div(
+            className='dropdowns',
+            children=[
+                dcc.Dropdown(
+                    id='keyword',
+                    options=corpus.getSearchOptions(corpus.keywordSearch, '', None),
+                    value='Keywords',
+                    multi=True,
+                    placeholder='Select keywords (OR)'
+                ),
+                dcc.Dropdown(
+                    id='author',
+                    options=corpus.getSearchOptions(corpus.authorSearch, '', None),
+                    value='Name',
+                    multi=True,
+                    placeholder='Select authors (OR)'
+                ),
+                dcc.Input(
+                    id='textSearch',
+                    type='search',
+                    debounce=True,
+                    placeholder=corpus.searchPlaceholder
+                )
+            ]
         ),
-        className='fullheight'
-    )])
-
-layout_authors_pages = html.Div(children=[
-    header,
-    html.Div(
+        dcc.RangeSlider(
+            id='yearRange',
+            min=corpus.firstYear,
+            max=corpus.lastYear,
+            step=1,
+            value=[corpus.firstYear, corpus.lastYear],
+            marks={int(year): str(year) for year in corpus.years if year % 10 == 0},
+            allowCross=False,
+            tooltip={'placement': 'bottom'}
+        ),
+        html.P(
+            id='articleCount',
+            children=''),
+        html.P(
+            id='exportLinks',
+            children=''),
         dcc.Graph(
-            id='authorsByPages',
-            figure=px.bar(
-                authorsDataByPageCount,
-                x='PagesTotal',
-                y='Name',
-                orientation='h',
-                title='Authors by Page Count',
-                hover_name='Name',
-                hover_data={'Name': False}
+            id='articlesByYearFigure',
+            clear_on_unhover=True
+        ),
+        html.P(
+            id='articleHover',
+            children=''),
+        html.Div([
+            html.H2(
+                children='Selected Article: '
             ),
-            style={'height': len(authorsDataByArticleCount)*15},
+            html.P([
+                html.Span(
+                    id='articleInfo',
+                    children=''
+                    ),
+                html.Br(),
+                'Link to DiVA page: ',
+                html.A(
+                    id='outbound-link',
+                    href='',
+                    target='_blank',
+                    children='',
+                    title=''),
+                html.Br(),
+                'Direct link to PDF: ',
+                html.A(
+                    id='pdf-link',
+                    href='',
+                    target='_blank',
+                    children='',
+                    title='')
+            ])], className='one column'
+        )])
+
+
+def getStatisticsLayout(corpus, name):
+    graph = dcc.Graph(
+        id='statisticsFigure',
+        figure=corpus.getStatisticsFigure(name),
+        style=corpus.getStatisticsStyle(name, 'top', '', 0)
+    )
+    controls = html.Div(children=[
+        dcc.Store(id='statisticsView', data=name),
+        dcc.Store(id='statisticsPage', data=0),
+        dcc.Input(id='statisticsSearch', type='text', debounce=True, placeholder='Search'),
+        dcc.RadioItems(
+            id='statisticsOrder',
+            options=[
+                {'label': 'Earliest first' if name.endswith('period') else 'Most first', 'value': 'top'},
+                {'label': 'Latest first' if name.endswith('period') else 'Least first', 'value': 'bottom'},
+                {'label': 'A–Ö', 'value': 'name'}
+            ],
+            value='top',
+            labelStyle={'display': 'inline-block'}
+        ),
+        html.Button('Previous', id='statisticsPrevious'),
+        html.Span(corpus.getStatisticsPageInfo(name, 'top', '', 0), id='statisticsPageInfo'),
+        html.Button('Next', id='statisticsNext')
+    ])
+    if name.endswith('period'):
+        content = ['Bars show timespan from earliest to latest published article. Mean publishing year displayed on hover.', graph]
+    else:
+        content = graph
+    return html.Div(children=[
+        getHeader(corpus),
+        controls,
+        html.Div(content, className='fullheight')
+    ])
+
+
+def getKeywordsAuthorLayout(corpus):
+    topAuthor = corpus.authorsData['Name'].iloc[0] if len(corpus.authorsData) else None
+    return html.Div(children=[
+        getHeader(corpus),
+        html.P('Select author to display most used keywords.'),
+        dcc.Dropdown(
+            id='authorKeywords',
+            options=corpus.getSearchOptions(corpus.authorSearch, '', topAuthor),
+            value=topAuthor,
+            multi=False,
+            placeholder='Select author',
         ),
-        className='fullheight'
-    )])
-
-layout_authors_period = html.Div(children=[
-    header,
-    html.Div([
-        'Bars show timespan from earliest to latest published article. Mean publishing year displayed on hover.',
         dcc.Graph(
-            id='authorsByPeriod',
-            figure=px.timeline(
-                authorsDataByEarliestArticle,
-                x_start='EarliestArticle',
-                x_end='LatestArticle',
-                y='Name',
-                title='Authors by Active Period',
-                hover_name='Name',
-                hover_data={
-                    'EarliestArticle': '|%Y',
-                    'LatestArticle': False,
-                    'LatestArticleYear': True,
-                    'ArticleMeanRounded': True,
-                    'Name': False
-                }
-            ),
-            style={'height': len(authorsDataByArticleCount)*15}
-        )],
-        className='fullheight'
-    )])
-
-layout_keywords_author = html.Div(children=[
-    header,
-    html.P('Select author to display most used keywords.'),
-    dcc.Dropdown(
-        id='authorKeywords',
-        options=[{'label': i, 'value': i} for i in unique_authors],
-        value='Hammarstedt, Nils Edvard',
-        multi=False,
-        placeholder='Select author',
-    ),
-    dcc.Graph(
-        id='keywordsByAuthor'
-    )])
-
-layout_keywords_articles = html.Div(children=[
-    header,
-    html.Div(
+            id='keywordsByAuthor'
+        )])
+
+
+def getRelatedKeywordsLayout(corpus):
+    keyword = 'Folktro' if 'Folktro' in corpus.keywordIds else (corpus.keywordsData['Keyword'].iloc[0] if len(corpus.keywordsData) else None)
+    return html.Div(children=[
+        getHeader(corpus),
+        html.P('Select keywords to display the keywords most often used together with them, and the authors using them most.'),
+        dcc.Dropdown(
+            id='relatedKeywords',
+            options=corpus.getSearchOptions(corpus.keywordSearch, '', keyword),
+            value=keyword,
+            multi=True,
+            placeholder='Select keywords (OR)'
+        ),
+        dcc.RadioItems(
+            id='relatedScore',
+            options=[
+                {'label': 'Jaccard (share of articles in common)', 'value': 'jaccard'},
+                {'label': 'PMI (how much more often than by chance)', 'value': 'pmi'},
+                {'label': 'Articles in common', 'value': 'count'}
+            ],
+            value='jaccard',
+            labelStyle={'display': 'inline-block'}
+        ),
         dcc.Graph(
-            id='keywordsByArticles',
-            figure=px.bar(
-                keywordsDataByArticleCount,
-                x='ArticlesTotal',
-                y='Keyword',
-                orientation='h',
-                title='Keywords by Article Count',
-                hover_name='Keyword',
-                hover_data={'Keyword': False}
-            ),
-            style={'height': len(keywordsDataByArticleCount)*15},
+            id='relatedKeywordsFigure'
         ),
-        className='fullheight'
-    )])
-
-layout_keywords_pages = html.Div(children=[
-    header,
-    html.Div(
         dcc.Graph(
-            id='keywordsByPages',
-            figure=px.bar(
-                keywordsDataByPageCount,
-                x='PagesTotal',
-                y='Keyword',
-                orientation='h',
-                title='Keywords by Page Count',
-                hover_name='Keyword',
-                hover_data={'Keyword': False}
-            ),
-            style={'height': len(keywordsDataByArticleCount)*15},
+            id='relatedAuthorsFigure'
+        )])
+
+
+def getTrendsLayout(corpus):
+    topKeywords = list(corpus.keywordsData['Keyword'].iloc[:3])
+    return html.Div(children=[
+        getHeader(corpus),
+        html.P('Select keywords and authors to compare their articles or pages over time.'),
+        dcc.Dropdown(
+            id='trendKeywords',
+            options=corpus.getSearchOptions(corpus.keywordSearch, '', topKeywords),
+            value=topKeywords,
+            multi=True,
+            placeholder='Select keywords'
+        ),
+        dcc.Dropdown(
+            id='trendAuthors',
+            options=corpus.getSearchOptions(corpus.authorSearch, '', None),
+            value=[],
+            multi=True,
+            placeholder='Select authors'
+        ),
+        dcc.RadioItems(
+            id='trendMeasure',
+            options=[
+                {'label': 'Articles', 'value': 'articles'},
+                {'label': 'Pages', 'value': 'pages'}
+            ],
+            value='articles',
+            labelStyle={'display': 'inline-block'}
+        ),
+        dcc.RadioItems(
+            id='trendBin',
+            options=[
+                {'label': 'Per year', 'value': 1},
+                {'label': 'Per 5 years', 'value': 5},
+                {'label': 'Per decade', 'value': 10}
+            ],
+            value=5,
+            labelStyle={'display': 'inline-block'}
         ),
-        className='fullheight'
-    )])
-
-layout_keywords_period = html.Div(children=[
-    header,
-    html.Div([
-        'Bars show timespan from earliest to latest published article. Mean publishing year displayed on hover.',
         dcc.Graph(
-            id='keywordsByPeriod',
-            figure=px.timeline(
-                keywordsDataByEarliestArticle,
-                x_start='EarliestArticle',
-                x_end='LatestArticle',
-                y='Keyword',
-                title='Keywords by Active Period',
-                hover_name='Keyword',
-                hover_data={
-                    'EarliestArticle': '|%Y',
-                    'LatestArticle': False,
-                    'LatestArticleYear': True,
-                    'ArticleMeanRounded': True,
-                    'Keyword': False
-                }
-            ),
-            style={'height': len(keywordsDataByArticleCount)*15}
-        )],
-        className='fullheight'
-    )])
-
-layout_about = html.Div(children=[
-    header,
-    html.P([
-        'Explore the content of Fataburen, the yearbook/journal of Nordiska museet & Skansen. Work in progress by ',
-        html.A(
-            children='Aron Ambrosiani',
-            href='https://twitter.com/AronAmbrosiani/'
-            ),
-        '. Code available at ',
-        html.A(
-            children='github.com/ambrosiani/fataburen/',
-            href='https://github.com/ambrosiani/fataburen/'),
-        ' as open source. Please reuse and adapt if you find it useful!'
-        ]),
-    html.P([
-        'This website was made as a final project for the course ',
-        html.A(
-            children='4ME501: Programming for Digital Humanities',
-            href='https://lnu.se/en/course/programming-for-digital-humanities/vaxjo-distance-international-part-time-autumn/'),
-        ' given at Linneaus University during the Autumn 2020 semester.'
-        ]),
-    html.P([
-        'The presented data was exported from ',
-        html.A(
-            children='DiVA',
-            href='http://www.diva-portal.org/'
-            ),
-        ' using the following feed url: ',
-        html.Br(),
-        html.A(
-            children='http://www.diva-portal.org/smash/export.jsf?format=csvall&addFilename=true&aq=[[]]&aqe=[]&aq2=[[{”seriesISSN”:”0348-971X","organisationId-Xtra":false},{"publicationTypeCode":["chapter"]}]]&onlyFullText=false&noOfRows=2000&sortOrder=title_sort_asc&sortOrder2=dateIssued_sort_asc',
-            href='http://www.diva-portal.org/smash/export.jsf?format=csvall&addFilename=true&aq=[[]]&aqe=[]&aq2=[[{”seriesISSN”:”0348-971X","organisationId-Xtra":false},{"publicationTypeCode":["chapter"]}]]&onlyFullText=false&noOfRows=2000&sortOrder=title_sort_asc&sortOrder2=dateIssued_sort_asc')
-        ]
-    )])
+            id='trendFigure'
+        )])
 
-# Add layouts to app
 
-app.layout = url_bar_and_content_div
+def getAboutLayout(corpus):
+    about = [
+        getHeader(corpus),
+        html.P([
+            corpus.description + ' Work in progress by ',
+            html.A(
+                children='Aron Ambrosiani',
+                href='https://twitter.com/AronAmbrosiani/'
+                ),
+            '. Code available at ',
+            html.A(
+                children='github.com/ambrosiani/fataburen/',
+                href='https://github.com/ambrosiani/fataburen/'),
+            ' as open source. Please reuse and adapt if you find it useful!'
+            ]),
+        html.P([
+            'This website was made as a final project for the course ',
+            html.A(
+                children='4ME501: Programming for Digital Humanities',
+                href='https://lnu.se/en/course/programming-for-digital-humanities/vaxjo-distance-international-part-time-autumn/'),
+            ' given at Linneaus University during the Autumn 2020 semester.'
+            ])]
+    if corpus.exportUrl:  # the feed of the corpus, from its corpus.json
+        about.append(html.P([
+            'The presented data was exported from ',
+            html.A(
+                children='DiVA',
+                href='http://www.diva-portal.org/'
+                ),
+            ' using the following feed url: ',
+            html.Br(),
+            html.A(
+                children=corpus.exportUrl,
+                href=corpus.exportUrl)
+            ]
+        ))
+    return html.Div(children=about)
+
 
-app.validation_layout = html.Div([
-    url_bar_and_content_div,
-    layout_explore,
-    layout_authors_articles,
-    layout_authors_pages,
-    layout_authors_period,
-    layout_keywords_author,
-    layout_keywords_articles,
-    layout_keywords_pages,
-    layout_keywords_period,
-    layout_about])
+# Add layouts to app (the pages are built per corpus by display_page)
+
+app.layout = url_bar_and_content_div
 
 
 # Callback for layout switching
 @app.callback(Output('page-content', 'children'),
               Input('url', 'pathname'))
+@instrument('display_page')
 def display_page(pathname):
-    if pathname == "/explore":
-        return layout_explore
-    elif pathname == "/authors-articles":
-        return layout_authors_articles
-    elif pathname == "/authors-pages":
-        return layout_authors_pages
-    elif pathname == "/authors-period":
-        return layout_authors_period
-    elif pathname == "/keywords-author":
-        return layout_keywords_author
-    elif pathname == "/keywords-articles":
-        return layout_keywords_articles
-    elif pathname == "/keywords-pages":
-        return layout_keywords_pages
-    elif pathname == "/keywords-period":
-        return layout_keywords_period
-    elif pathname == "/about":
-        return layout_about
+    corpusName, page = getRoute(pathname)
+    corpus = corpora.get(corpusName)
+    if corpus is None:
+        return html.P('Unknown corpus ' + corpusName)
+    if len(corpus.articleData) == 0 and page != "about":  # e.g. the NBN filter of the corpus matched no articles
+        return html.Div(children=[getHeader(corpus), html.P('There are no articles in this corpus.')])
+    if page in statisticsViews:
+        return getStatisticsLayout(corpus, page)
+    elif page == "keywords-author":
+        return getKeywordsAuthorLayout(corpus)
+    elif page == "related-keywords":
+        return getRelatedKeywordsLayout(corpus)
+    elif page == "trends":
+        return getTrendsLayout(corpus)
+    elif page == "about":
+        return getAboutLayout(corpus)
+    else:
+        return getExploreLayout(corpus)
+
+
+# Callback for search, order and paging on the statistics views
+@app.callback(
+    Output('statisticsFigure', 'figure'),
+    Output('statisticsFigure', 'style'),
+    Output('statisticsPageInfo', 'children'),
+    Output('statisticsPage', 'data'),
+    Input('statisticsSearch', 'value'),
+    Input('statisticsOrder', 'value'),
+    Input('statisticsPrevious', 'n_clicks'),
+    Input('statisticsNext', 'n_clicks'),
+    State('statisticsView', 'data'),
+    State('statisticsPage', 'data'),
+    State('corpus', 'data'),
+    prevent_initial_call=True)
+@instrument('update_statistics')
+def update_statistics(search, order, previous_clicks, next_clicks, name, page, corpus_name):
+    corpus = getCorpus(corpus_name)
+    search = (search or '').strip()
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    if 'statisticsPrevious.n_clicks' in triggered:
+        page = page - 1
+    elif 'statisticsNext.n_clicks' in triggered:
+        page = page + 1
+    else:  # new search or order starts from the top
+        page = 0
+    pageCount = max(1, -(-corpus.getStatisticsRowCount(name, order, search) // statisticsPageSize))
+    page = min(max(page, 0), pageCount-1)
+
+    if order == 'top' and not search and page == 0:
+        figure = corpus.getStatisticsFigure(name)
     else:
-        return layout_explore
+        cacheKey = [corpus.name, corpus.dataVersion, name, order, search, page]
+        figure = graphCache.get(cacheKey)
+        if figure is None:
+            figure = graphCache.set(cacheKey, corpus.buildStatisticsFigure(name, order, search, page).to_plotly_json())
+    return figure, corpus.getStatisticsStyle(name, order, search, page), corpus.getStatisticsPageInfo(name, order, search, page), page
 
 
-# Callback for graph clicks on Explore view
+# Callbacks for graph clicks and hovers on Explore view; the figure only holds the PID of each
+# article, the details are looked up in the corpus
 @app.callback(
     Output('outbound-link', 'children'),
     Output('outbound-link', 'href'),
@@ -370,76 +485,280 @@ def display_page(pathname):
     Output('pdf-link', 'children'),
     Output('pdf-link', 'href'),
     Output('pdf-link', 'title'),
-    Input('articlesByYearFigure', 'clickData'))
-def display_click_data(clickData):
-    if clickData is not None:
-        print('Selected article: '+str(clickData['points'][0]['customdata'][0]) + ' (' + str(clickData['points'][0]['customdata'][1]) + ')\n')
-        return clickData['points'][0]['customdata'][1], 'https://urn.kb.se/resolve?urn=' + str(clickData['points'][0]['customdata'][1]), clickData['points'][0]['customdata'][0], ['Title: ', html.B(children=clickData['points'][0]['customdata'][0]), html.Br(), 'Year: ', html.B(children=clickData['points'][0]['x']), html.Br(), 'Pages: ', html.B(children=clickData['points'][0]['y']), html.Br(), 'Authors: ', html.B(children=clickData['points'][0]['customdata'][3]), html.Br(), 'Keywords:', html.B(children=clickData['points'][0]['customdata'][2]), html.Br(), html.A(children='Open PDF in Voyant Tools', target='_blank', href='http://voyant-tools.org/?input=http://nordiskamuseet.diva-portal.org/smash/get/diva2:'+str(clickData['points'][0]['customdata'][4])+'/FULLTEXT01.pdf&stopList=stop.se.swedish-long.txt&panels=cirrus,reader,trends,summary,contexts')], clickData['points'][0]['customdata'][0], 'http://nordiskamuseet.diva-portal.org/smash/get/diva2:'+str(clickData['points'][0]['customdata'][4])+'/FULLTEXT01.pdf', str(clickData['points'][0]['customdata'][0])+' (PDF)'
+    Input('articlesByYearFigure', 'clickData'),
+    State('corpus', 'data'))
+@instrument('display_click_data')
+def display_click_data(clickData, corpus_name):
+    if clickData is not None and 'customdata' not in clickData['points'][0]:  # yearly totals, no single article
+        return '', '', '', 'Zoom in or narrow the selection to select a single article.', '', '', ''
+    elif clickData is not None:
+        corpus = getCorpus(corpus_name)
+        article = corpus.getArticle(clickData['points'][0]['customdata'])
+        if article is None:  # figure drawn from older data
+            return '', '', '', 'Reload the page to select this article.', '', '', ''
+        logger.info('Selected article: %s (%s)', article['Title'], article['NBN'])
+        pdfUrl = corpus.pdfUrl.format(pid=article['PID'])
+        return article['NBN'], 'https://urn.kb.se/resolve?urn=' + str(article['NBN']), article['Title'], ['Title: ', html.B(children=article['Title']), html.Br(), 'Year: ', html.B(children=clickData['points'][0]['x']), html.Br(), 'Pages: ', html.B(children=clickData['points'][0]['y']), html.Br(), 'Authors: ', html.B(children=article['Name']), html.Br(), 'Keywords:', html.B(children=article['Keywords']), html.Br(), html.A(children='Open PDF in Voyant Tools', target='_blank', href='http://voyant-tools.org/?input='+pdfUrl+'&stopList=stop.se.swedish-long.txt&panels=cirrus,reader,trends,summary,contexts')], article['Title'], pdfUrl, str(article['Title'])+' (PDF)'
     else:
-        print('Selected article: None\n')
+        logger.info('Selected article: None')
         return '', '', '', '', '', '', ''
 
 
-# Callback for keyword & author dropdowns on Explore view
+@app.callback(
+    Output('articleHover', 'children'),
+    Input('articlesByYearFigure', 'hoverData'),
+    State('corpus', 'data'))
+@instrument('display_hover_data')
+def display_hover_data(hoverData, corpus_name):
+    if hoverData is None or 'customdata' not in hoverData['points'][0]:
+        return ''
+    article = getCorpus(corpus_name).getArticle(hoverData['points'][0]['customdata'])
+    if article is None:
+        return ''
+    return [html.B(children=article['Title']), ' (' + str(article['Year']) + ') ', article['Name']]
+
+
+# Callbacks for the type-ahead search in the dropdowns
+
+@app.callback(
+    Output('keyword', 'options'),
+    Input('keyword', 'search_value'),
+    State('keyword', 'value'),
+    State('corpus', 'data'))
+@instrument('search_keywords')
+def search_keywords(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.keywordSearch, search_value, value, 'Keywords')
+
+
+@app.callback(
+    Output('author', 'options'),
+    Input('author', 'search_value'),
+    State('author', 'value'),
+    State('corpus', 'data'))
+@instrument('search_authors')
+def search_authors(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.authorSearch, search_value, value, 'Name')
+
+
+@app.callback(
+    Output('authorKeywords', 'options'),
+    Input('authorKeywords', 'search_value'),
+    State('authorKeywords', 'value'),
+    State('corpus', 'data'))
+@instrument('search_author_keywords')
+def search_author_keywords(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.authorSearch, search_value, value)
+
+
+@app.callback(
+    Output('relatedKeywords', 'options'),
+    Input('relatedKeywords', 'search_value'),
+    State('relatedKeywords', 'value'),
+    State('corpus', 'data'))
+@instrument('search_related_keywords')
+def search_related_keywords(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.keywordSearch, search_value, value)
+
+
+@app.callback(
+    Output('trendKeywords', 'options'),
+    Input('trendKeywords', 'search_value'),
+    State('trendKeywords', 'value'),
+    State('corpus', 'data'))
+@instrument('search_trend_keywords')
+def search_trend_keywords(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.keywordSearch, search_value, value)
+
+
+@app.callback(
+    Output('trendAuthors', 'options'),
+    Input('trendAuthors', 'search_value'),
+    State('trendAuthors', 'value'),
+    State('corpus', 'data'))
+@instrument('search_trend_authors')
+def search_trend_authors(search_value, value, corpus_name):
+    corpus = getCorpus(corpus_name)
+    return corpus.getSearchOptions(corpus.authorSearch, search_value, value)
+
+
+# Callback for keyword & author dropdowns (and zooming) on Explore view
 @app.callback(
     Output('articlesByYearFigure', 'figure'),
     Output('articleCount', 'children'),
     Input('keyword', 'value'),
-    Input('author', 'value'))
-def update_graph(selected_keywords, selected_authors):
-    if selected_keywords == 'Keywords' or selected_keywords is None or selected_keywords == []:  # all these are versions of "Select all"
-        print('Selected keywords: None')
-        filteredArticleData = articleData
-    else:
-        print('Selected keywords:', selected_keywords)
-        filteredArticleData = filterByTokens(articleData, selected_keywords, 'Keywords')
-
-    if selected_authors == 'Name' or selected_authors is None or selected_authors == []:  # all these are versions of "Select all"
-        print('Selected authors: None\n')
-    else:
-        print('Selected authors:', selected_authors, '\n')
-        filteredArticleData = filterByTokens(filteredArticleData, selected_authors, 'Name')
-
-    fig = px.bar(filteredArticleData, x='Year', y='Pages', hover_data=['Title', 'NBN', 'Keywords', 'Name', 'PID'], barmode='stack')
-    fig.update_layout(transition_duration=500)
-    return fig, str(len(filteredArticleData))+' articles selected'
+    Input('author', 'value'),
+    Input('textSearch', 'value'),
+    Input('yearRange', 'value'),
+    Input('articlesByYearFigure', 'relayoutData'),
+    State('corpus', 'data'))
+@instrument('update_graph')
+def update_graph(selected_keywords, selected_authors, search_text, year_range, relayoutData, corpus_name):
+    corpus = getCorpus(corpus_name)
+    keywords = getSelection(selected_keywords, 'Keywords')
+    authors = getSelection(selected_authors, 'Name')
+    terms = ' '.join(sorted(set(getSearchTerms(search_text or ''))))
+    yearRange = corpus.getYearRange(year_range)
+    logger.info('Selected keywords: %s, authors: %s, search terms: %s, years: %s', keywords if keywords else 'None', authors if authors else 'None', terms if terms else 'None', yearRange if yearRange else 'All')
+    observeSelection('update_graph', 'keywords', len(keywords))
+    observeSelection('update_graph', 'authors', len(authors))
+
+    zoomedYears = None
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    if triggered == ['articlesByYearFigure.relayoutData']:
+        zoomedYears = corpus.getZoomedYears(relayoutData)
+        if zoomedYears is None and 'xaxis.autorange' not in (relayoutData or {}):
+            raise PreventUpdate  # not a zoom, e.g. autosize
+
+    cacheKey = [corpus.name, corpus.dataVersion, keywords, authors, terms, yearRange, zoomedYears]
+    result = graphCache.get(cacheKey)
+    if result is None:
+        with phase('update_graph', 'filter'):
+            selectedRows, matchingRows = corpus.selectArticles(keywords, authors, search_text, yearRange)
+            bestMatches = ' Best matches: ' + '; '.join(corpus.articleData['Title'].to_numpy()[matchingRows[:3]].astype(str)) if len(matchingRows) else ''
+            articleCount = len(selectedRows)
+
+            shownRows = selectedRows
+            if zoomedYears is not None:
+                shownRows = corpus.selectYears(selectedRows, zoomedYears[0], zoomedYears[1])
+        observeSelection('update_graph', 'articles', articleCount)
+
+        with phase('update_graph', 'figure'):
+            if len(shownRows) <= detailLimit:
+                fig = px.bar(corpus.articleData.iloc[shownRows], x='Year', y='Pages', barmode='stack', template=barTemplate)
+                fig.update_traces(customdata=corpus.articleData['PID'].to_numpy()[shownRows], hovertemplate='Year: %{x}<br>Pages: %{y}<extra></extra>')  # title and authors are shown by display_hover_data
+                countText = str(articleCount)+' articles selected.'+bestMatches
+            else:
+                yearArticles, yearPages = corpus.getYearTotals(keywords, authors, terms, selectedRows)
+                shownYears = slice(None) if yearRange is None else slice(yearRange[0]-corpus.firstYear, yearRange[1]-corpus.firstYear+1)
+                fig = px.bar({'Year': corpus.years[shownYears], 'Pages': yearPages[shownYears], 'Articles': yearArticles[shownYears]}, x='Year', y='Pages', text='Articles', template=barTemplate)
+                fig.update_traces(textposition='none', hovertemplate='Year: %{x}<br>Pages: %{y}<br>Articles: %{text}<extra></extra>')
+                countText = str(articleCount)+' articles selected (totals per year, zoom in or narrow the selection to see single articles).'+bestMatches
+
+            fig.update_layout(transition_duration=500)
+            if zoomedYears is not None:
+                fig.update_xaxes(range=[zoomedYears[0]-0.5, zoomedYears[1]+0.5])
+            figure = fig.to_plotly_json()
+
+        with phase('update_graph', 'cache'):
+            result = graphCache.set(cacheKey, [figure, countText])
+    return result[0], result[1]
+
+
+# Callback for the download links of the Explore selection
+@app.callback(
+    Output('exportLinks', 'children'),
+    Input('keyword', 'value'),
+    Input('author', 'value'),
+    Input('textSearch', 'value'),
+    Input('yearRange', 'value'),
+    State('corpus', 'data'))
+@instrument('update_export_links')
+def update_export_links(selected_keywords, selected_authors, search_text, year_range, corpus_name):
+    corpus = getCorpus(corpus_name)
+    query = [('keyword', keyword) for keyword in getSelection(selected_keywords, 'Keywords')] + [('author', author) for author in getSelection(selected_authors, 'Name')]
+    if getSearchTerms(search_text or ''):
+        query.append(('q', search_text))
+    yearRange = corpus.getYearRange(year_range)
+    if yearRange is not None:
+        query += [('from', yearRange[0]), ('to', yearRange[1])]
+    query = '?' + urllib.parse.urlencode(query) if query else ''
+    links = ['Download selection:']
+    for kind in exportColumns:
+        href = '/' + corpus.name + '/export/' + kind
+        links += [' ' + kind + ' (', html.A(children='CSV', href=href + '.csv' + query), ', ', html.A(children='NDJSON', href=href + '.ndjson' + query), ')']
+    return links
 
 
 # Callback for Author dropdown on Keywords by Author view
 @app.callback(
     Output('keywordsByAuthor', 'figure'),
     Output('keywordsByAuthor', 'style'),
-    Input('authorKeywords', 'value'))
-def update_graph2(selected_author):
-    print('Selected author:', selected_author, '\n')
-    filteredAuthorsData = authorsData[authorsData['Name'].str.contains(selected_author, na=False, regex=False)]
-    listOfKeywordsString = filteredAuthorsData['KeywordsUsed'].iloc[0]
-
-    listOfKeywordsToProcess = re.split('[,]', listOfKeywordsString)
-    listOfKeywords = []
-    itemToAdd = []
-    odd = True
-    for item in listOfKeywordsToProcess:
-        item = item.strip('[]) ')
-        item = item.strip('(')
-        item = item.strip('\'')
-        itemToAdd.append(item)
-        if not odd:
-            listOfKeywords.append(itemToAdd)
-            itemToAdd = []
-            odd = True
+    Input('authorKeywords', 'value'),
+    State('corpus', 'data'))
+@instrument('update_graph2')
+def update_graph2(selected_author, corpus_name):
+    corpus = getCorpus(corpus_name)
+    logger.info('Selected author: %s', selected_author)
+    with phase('update_graph2', 'filter'):
+        authorId = corpus.authorIds.get(selected_author)
+        if authorId is None:
+            authorKeywords = corpus.authorKeywordData.iloc[0:0]
         else:
-            odd = False
-
-    fig = px.bar(
-        listOfKeywords,
-        x=1,
-        y=0,
-        orientation='h',
-        hover_name=0
-    )
+            authorKeywords = corpus.authorKeywordData.iloc[corpus.authorKeywordStart[authorId]:corpus.authorKeywordStart[authorId+1]]
+    observeSelection('update_graph2', 'keywords', len(authorKeywords))
+
+    with phase('update_graph2', 'figure'):
+        listOfKeywords = {
+            'Keyword': corpus.keywordsData['Keyword'].to_numpy()[authorKeywords['KeywordId'].to_numpy()],
+            'Count': authorKeywords['Count'].to_numpy()
+        }
+
+        fig = px.bar(
+            listOfKeywords,
+            x='Count',
+            y='Keyword',
+            orientation='h',
+            hover_name='Keyword'
+        )
+        fig.update_layout(transition_duration=500, yaxis={'categoryorder': 'total ascending'})
+    return fig, {'height': len(authorKeywords)*20}
+
+
+# Callback for keyword dropdown & score on Related Keywords view
+@app.callback(
+    Output('relatedKeywordsFigure', 'figure'),
+    Output('relatedKeywordsFigure', 'style'),
+    Output('relatedAuthorsFigure', 'figure'),
+    Output('relatedAuthorsFigure', 'style'),
+    Input('relatedKeywords', 'value'),
+    Input('relatedScore', 'value'),
+    State('corpus', 'data'))
+@instrument('update_related')
+def update_related(selected_keywords, score, corpus_name):
+    corpus = getCorpus(corpus_name)
+    keywords = getSelection(selected_keywords, None)
+    logger.info('Selected keywords: %s (%s)', keywords if keywords else 'None', score)
+    observeSelection('update_related', 'keywords', len(keywords))
+    keywordIdList = [corpus.keywordIds[keyword] for keyword in keywords if keyword in corpus.keywordIds]
+
+    related = corpus.getRelatedKeywords(keywordIdList, score)
+    fig = px.bar(related, x='Score', y='Keyword', orientation='h', hover_name='Keyword', hover_data=['Articles'])
     fig.update_layout(transition_duration=500, yaxis={'categoryorder': 'total ascending'})
-    return fig, {'height': len(listOfKeywords)*20}
+
+    listOfAuthors = corpus.getRelatedAuthors(keywordIdList)
+    fig2 = px.bar(listOfAuthors, x='Count', y='Author', orientation='h', hover_name='Author')
+    fig2.update_layout(transition_duration=500, yaxis={'categoryorder': 'total ascending'})
+    return fig, {'height': 100 + len(related)*20}, fig2, {'height': 100 + len(listOfAuthors)*20}
+
+
+# Callback for keyword & author dropdowns, measure and bin size on Trends view
+@app.callback(
+    Output('trendFigure', 'figure'),
+    Input('trendKeywords', 'value'),
+    Input('trendAuthors', 'value'),
+    Input('trendMeasure', 'value'),
+    Input('trendBin', 'value'),
+    State('corpus', 'data'))
+@instrument('update_trends')
+def update_trends(selected_keywords, selected_authors, measure, bin_size, corpus_name):
+    corpus = getCorpus(corpus_name)
+    keywords = getSelection(selected_keywords, None)
+    authors = getSelection(selected_authors, None)
+    logger.info('Selected keywords: %s, authors: %s (%s per %s years)', keywords if keywords else 'None', authors if authors else 'None', measure, bin_size)
+    observeSelection('update_trends', 'keywords', len(keywords))
+    observeSelection('update_trends', 'authors', len(authors))
+
+    trends = corpus.getTrends(keywords, authors, measure, int(bin_size))
+    label = 'Articles' if measure == 'articles' else 'Pages'
+    fig = px.line(trends, x='Year', y='Value', color='Name', line_dash='Type', labels={'Value': label})
+    fig.update_traces(mode='lines+markers')
+    fig.update_layout(transition_duration=500)
+    return fig
 
 
 if __name__ == '__main__':
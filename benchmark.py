@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Benchmarks on synthetic DiVA exports. Each corpus size gets its own temporary directory:
+# prepare_data.py runs there as a subprocess, then a second subprocess (this script with
+# --worker) imports the app from the prepared files and times the functions and callbacks.
+#
+#   python benchmark.py --articles 1000 10000 100000 --output results.json
+
+repoPath = os.path.dirname(os.path.abspath(__file__))
+
+# Columns of a DiVA csvall export; the ones prepare_data.py does not read are left empty
+exportHeader = ['PID', 'Name', 'Title', 'PublicationType', 'ContentType', 'Language', 'Journal', 'JournalISSN', 'JournalEISSN', 'Status', 'Volume', 'Issue', 'HostPublication', 'StartPage', 'EndPage', 'Year', 'Edition', 'Pages', 'City', 'Publisher', 'Series', 'SeriesISSN', 'SeriesEISSN', 'ISBN', 'Urls', 'ISRN', 'DOI', 'ISI', 'PMID', 'ScopusId', 'NBN', 'LocalId', 'ArchiveNumber', 'Keywords', 'Categories', 'ResearchSubjects', 'Projects', 'Notes', 'Abstract', 'Opponents', 'Supervisors', 'Examiners', 'Patent', 'ThesisLevel', 'Credits', 'Programme', 'Subject', 'Uppsok', 'DefencePlace', 'DefenceLanguage', 'DefenceDate', 'CreatedDate', 'PublicationDate', 'LastUpdated']
+
+syllables = ['berg', 'dal', 'ström', 'lund', 'qvist', 'gren', 'holm', 'sjö', 'å', 'kvarn', 'gård', 'by', 'näs', 'ek', 'björk', 'lin', 'sten', 'mark', 'fors', 'vik', 'hed', 'ö', 'rot', 'fält']
+firstNames = ['Anna', 'Nils', 'Gösta', 'Eva', 'Sigurd', 'Kersti', 'Bo', 'Åsa', 'Per', 'Märta', 'Sten', 'Ingrid', 'Erik', 'Ulla', 'Örjan', 'Birgitta']
+
+
+def getWords(count, random):
+    # made-up Swedish-looking words of two to five syllables, unique
+    parts = np.array(syllables + [''], dtype=object)
+    words = np.array([], dtype=object)
+    while len(words) < count:
+        ids = random.integers(0, len(syllables), (count, 5))
+        ids[:, 2:][random.random((count, 3)) < 0.5] = len(syllables)  # '' syllable
+        words = np.unique(np.concatenate([words, parts[ids].sum(axis=1)]))
+    return sorted(random.permutation(words)[:count])
+
+
+def sampleZipf(random, size, vocabularySize, exponent):
+    # token ids 0..vocabularySize-1, id 0 most frequent
+    weights = 1 / np.arange(1, vocabularySize+1)**exponent
+    return random.choice(vocabularySize, size=size, p=weights/weights.sum())
+
+
+def joinTokens(articleIds, tokens, articleCount):
+    # ;-separated tokens per article, '' for articles without tokens
+    joined = pd.Series(tokens).groupby(articleIds).agg(';'.join)
+    return joined.reindex(np.arange(articleCount), fill_value='').to_numpy()
+
+
+def generateExport(path, articleCount, seed):
+    random = np.random.default_rng(seed)
+    authorCount = max(20, int(articleCount*0.45))  # Fataburen: ~780 authors and ~1490 keywords for ~1800 articles
+    keywordCount = max(20, int(articleCount*0.8))
+
+    surnames = getWords(authorCount, random)
+    authors = np.array([surname.capitalize() + ', ' + random.choice(firstNames) + ' (Nordiska museet [877150])' for surname in surnames], dtype=object)
+    keywords = np.array([word.capitalize() for word in getWords(keywordCount, random)], dtype=object)
+    titleWords = np.array(getWords(2000, random), dtype=object)
+
+    authorsPerArticle = 1 + random.poisson(0.2, articleCount)
+    authorArticles = np.repeat(np.arange(articleCount), authorsPerArticle)
+    authorTokens = authors[sampleZipf(random, len(authorArticles), authorCount, 1.1)]
+    keywordsPerArticle = random.poisson(2.3, articleCount)
+    keywordArticles = np.repeat(np.arange(articleCount), keywordsPerArticle)
+    keywordTokens = keywords[sampleZipf(random, len(keywordArticles), keywordCount, 1.0)]
+
+    titleLengths = random.integers(2, 8, articleCount)
+    titleArticles = np.repeat(np.arange(articleCount), titleLengths)
+    titleTokens = titleWords[sampleZipf(random, len(titleArticles), len(titleWords), 1.0)]
+    abstractArticles = np.flatnonzero(random.random(articleCount) < 0.1)
+    abstractArticles = np.repeat(abstractArticles, 40)
+    abstractTokens = titleWords[sampleZipf(random, len(abstractArticles), len(titleWords), 1.0)]
+
+    pids = np.arange(1000000, 1000000+articleCount)
+    startPages = random.integers(1, 300, articleCount)
+    export = pd.DataFrame({column: '' for column in exportHeader}, index=np.arange(articleCount))
+    export['PID'] = pids
+    export['Name'] = joinTokens(authorArticles, authorTokens, articleCount)
+    export['Title'] = [title.capitalize() for title in joinTokens(titleArticles, titleTokens, articleCount)]
+    export['Title'] = export['Title'].str.replace(';', ' ', regex=False)
+    export['StartPage'] = startPages
+    export['EndPage'] = startPages + random.geometric(0.1, articleCount)
+    export['Year'] = random.integers(1886, 2018, articleCount)
+    export['NBN'] = ['urn:nbn:se:nordiskamuseet:diva-' + str(pid) for pid in pids]
+    export['Keywords'] = joinTokens(keywordArticles, keywordTokens, articleCount)
+    export['Abstract'] = pd.Series(joinTokens(abstractArticles, abstractTokens, articleCount)).str.replace(';', ' ', regex=False)
+    export['LastUpdated'] = '2020-12-01'
+    export.to_csv(path, index=False)
+
+
+def timeCall(function, repeat):
+    # median and fastest of repeat calls, in seconds
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'median': float(np.median(times)), 'min': float(min(times)), 'repeat': repeat}
+
+
+def postCallback(client, outputs, inputs, changed, corpusName):
+    # call a Dash callback the way the browser does, returns the response size in bytes
+    response = client.post('/_dash-update-component', json={
+        'output': '..' + '...'.join(componentId + '.' + prop for componentId, prop in outputs) + '..' if len(outputs) > 1 else outputs[0][0] + '.' + outputs[0][1],
+        'outputs': [{'id': componentId, 'property': prop} for componentId, prop in outputs] if len(outputs) > 1 else {'id': outputs[0][0], 'property': outputs[0][1]},
+        'inputs': [{'id': componentId, 'property': prop, 'value': value} for componentId, prop, value in inputs],
+        'changedPropIds': [changed],
+        'state': [{'id': 'corpus', 'property': 'data', 'value': corpusName}]
+    })
+    if response.status_code not in [200, 204]:
+        raise RuntimeError('callback failed with status ' + str(response.status_code) + ': ' + response.get_data(as_text=True)[:200])
+    return len(response.get_data())
+
+
+def runWorker(repeat):
+    # runs in the corpus directory; prints the timings as json
+    results = {}
+    start = time.perf_counter()
+    import app
+    importSeconds = time.perf_counter() - start
+    results['appImport'] = {'median': importSeconds, 'min': importSeconds, 'repeat': 1}
+
+    import functions
+    from cache import ResultCache
+    from plotly.utils import PlotlyJSONEncoder
+
+    start = time.perf_counter()
+    corpus = app.corpora.get(app.defaultCorpus)
+    loadSeconds = time.perf_counter() - start
+    results['corpusLoad'] = {'median': loadSeconds, 'min': loadSeconds, 'repeat': 1, 'memoryMb': corpus.memory / 2**20}
+
+    app.graphCache = ResultCache(0)  # every call is a miss
+    rawData = pd.read_csv('fataburen_articles_diva_processed.csv')
+    topKeywords = corpus.keywordsData['Keyword'].tolist()[:3]
+    topAuthors = corpus.authorsData['Name'].tolist()[:2]
+    rareKeyword = corpus.keywordsData['Keyword'].tolist()[-1]
+
+    results['getTokenCountAsData'] = timeCall(lambda: functions.getTokenCountAsData(rawData, 'Keywords', 'Keyword', []), repeat)
+    results['filterByTokens.oneKeyword'] = timeCall(lambda: functions.filterByTokens(corpus.articleData, topKeywords[:1], 'Keywords'), repeat)
+    results['filterByTokens.threeKeywords'] = timeCall(lambda: functions.filterByTokens(corpus.articleData, topKeywords, 'Keywords'), repeat)
+
+    client = app.server.test_client()
+    explore = [('articlesByYearFigure', 'figure'), ('articleCount', 'children')]
+    allYears = [corpus.firstYear, corpus.lastYear]
+    selections = {
+        'all': ('Keywords', 'Name', None, allYears),
+        'topKeyword': (topKeywords[:1], 'Name', None, allYears),
+        'rareKeyword': ([rareKeyword], 'Name', None, allYears),
+        'keywordsAndAuthors': (topKeywords, topAuthors, None, allYears),
+        'textSearch': ('Keywords', 'Name', corpus.textIndex['terms'][len(corpus.textIndex['terms'])//2], allYears),
+        'lastDecade': ('Keywords', 'Name', None, [corpus.lastYear-9, corpus.lastYear])
+    }
+    for name, (keywords, authors, text, years) in selections.items():
+        inputs = [('keyword', 'value', keywords), ('author', 'value', authors), ('textSearch', 'value', text), ('yearRange', 'value', years), ('articlesByYearFigure', 'relayoutData', None)]
+        responseBytes = []
+        results['update_graph.' + name] = timeCall(lambda: responseBytes.append(postCallback(client, explore, inputs, 'keyword.value', corpus.name)), repeat)
+        results['update_graph.' + name]['bytes'] = responseBytes[-1]
+
+    responseBytes = []
+    inputs = [('authorKeywords', 'value', topAuthors[0])]
+    results['update_graph2'] = timeCall(lambda: responseBytes.append(postCallback(client, [('keywordsByAuthor', 'figure'), ('keywordsByAuthor', 'style')], inputs, 'authorKeywords.value', corpus.name)), repeat)
+    results['update_graph2']['bytes'] = responseBytes[-1]
+
+    exploreFigure = app.px.bar(corpus.articleData.iloc[:app.detailLimit], x='Year', y='Pages', barmode='stack', template=app.barTemplate)
+    exploreFigure.update_traces(customdata=corpus.articleData['PID'].to_numpy()[:app.detailLimit], hovertemplate='Year: %{x}<br>Pages: %{y}<extra></extra>')
+    results['figureJson.explore'] = timeCall(lambda: json.dumps(exploreFigure.to_plotly_json(), cls=PlotlyJSONEncoder), repeat)
+    statisticsFigure = functions.buildStatisticsFigure('keywords-articles', corpus.authorsData, corpus.keywordsData)
+    results['figureJson.statistics'] = timeCall(lambda: statisticsFigure.to_json(), repeat)
+
+    print(json.dumps(results))
+
+
+def runCorpus(articleCount, repeat, seed, keep):
+    directory = tempfile.mkdtemp(prefix='fataburen_benchmark_')
+    try:
+        start = time.perf_counter()
+        generateExport(os.path.join(directory, 'fataburen_articles_diva.csv'), articleCount, seed)
+        print('Generated', articleCount, 'articles in', round(time.perf_counter() - start, 1), 's', file=sys.stderr)
+
+        results = {}
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(repoPath, 'prepare_data.py')], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+        prepareSeconds = time.perf_counter() - start
+        results['prepare_data'] = {'median': prepareSeconds, 'min': prepareSeconds, 'repeat': 1, 'maxRssMb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}  # largest child so far
+
+        worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', '--repeat', str(repeat)], cwd=directory, check=True, stdout=subprocess.PIPE)
+        results.update(json.loads(worker.stdout.decode('utf-8').strip().splitlines()[-1]))  # the app prints selections to stdout
+        print('Benchmarked', articleCount, 'articles', file=sys.stderr)
+        return {'articles': articleCount, 'directory': directory if keep else None, 'results': results}
+    finally:
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def getVersions():
+    import dash
+    import plotly
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repoPath, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__, 'dash': dash.__version__, 'plotly': plotly.__version__}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time prepare_data.py and the app on synthetic DiVA exports.')
+    parser.add_argument('--articles', type=int, nargs='+', default=[1000, 10000], help='corpus sizes to benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='calls per timed function')
+    parser.add_argument('--seed', type=int, default=1886)
+    parser.add_argument('--output', help='write the results to this json file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary corpus directories')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        runWorker(args.repeat)
+    else:
+        report = {'versions': getVersions(), 'runs': [runCorpus(articleCount, args.repeat, args.seed, args.keep) for articleCount in args.articles]}
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as outputFile:
+                json.dump(report, outputFile, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+from plotly.utils import PlotlyJSONEncoder
+
+
+class ResultCache:
+    # Size-bounded LRU cache for callback results, keyed on any json-serializable key.
+    # With a directory, results are also written there as json files, so that all
+    # gunicorn workers (and restarts) reuse each other's results. The entries and counters are
+    # shared by the threads of a worker (gthread), so they are only touched under the lock.
+
+    def __init__(self, maxsize=256, directory=None, maxfiles=4096):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.maxfiles = maxfiles
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        key = json.dumps(key, ensure_ascii=False)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.directory is not None:
+            path = self.getPath(key)
+            try:
+                with open(path, encoding='utf-8') as cacheFile:
+                    value = json.load(cacheFile)
+                os.utime(path)  # mark as recently used for the disk eviction
+            except (OSError, ValueError):
+                pass
+            else:
+                self.remember(key, value, diskHit=True)
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        key = json.dumps(key, ensure_ascii=False)
+        self.remember(key, value)
+
+        if self.directory is not None:
+            path = self.getPath(key)
+            temporaryPath = path + '.' + str(os.getpid()) + '-' + str(threading.get_ident())  # one per writing thread
+            with open(temporaryPath, 'w', encoding='utf-8') as cacheFile:
+                json.dump(value, cacheFile, cls=PlotlyJSONEncoder)
+            os.replace(temporaryPath, path)  # atomic, other workers never read a partial file
+            self.evictFiles()
+        return value
+
+    def remember(self, key, value, diskHit=False):
+        with self.lock:
+            self.diskHits += diskHit
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def evictFiles(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    files.append((entry.stat().st_mtime, entry.path))
+                except OSError:  # evicted by another thread or worker meanwhile
+                    pass
+        if len(files) > self.maxfiles:
+            files.sort()
+            for _, path in files[:len(files)-self.maxfiles]:
+                try:
+                    os.remove(path)
+                except OSError:  # already evicted by another thread or worker
+                    pass
+
+    def stats(self):
+        with self.lock:
+            hits, diskHits, misses, entries = self.hits, self.diskHits, self.misses, len(self.entries)
+        requests = hits + diskHits + misses
+        return {
+            'entries': entries,
+            'maxsize': self.maxsize,
+            'hits': hits,
+            'diskHits': diskHits,
+            'misses': misses,
+            'hitRate': (hits + diskHits) / requests if requests else None,
+            'directory': self.directory
+        }
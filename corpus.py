@@ -0,0 +1,350 @@
+from collections import OrderedDict
+import json
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from functions import articleColumns, authorColumns, authorKeywordColumns, keywordColumns, keywordKeywordColumns, buildSearchIndex, buildStatisticsFigure, buildTokenIndex, compactData, defaultPdfUrl, getFigurePath, getSearchTerms, getSelection, getStatisticsOrder, getYearSpan, normalizeText, readCorpusSettings, readPreparedData, readTextIndex, readYearCubes, reorderTextIndex, searchText, searchTokens, selectByTokens, statisticsOrders, statisticsPageSize, statisticsViews, yearCubePath
+from metrics import logger
+
+# A corpus is a directory with the files written by prepare_data.py: the repository itself for
+# Fataburen, and one subdirectory of FATABUREN_CORPORA_DIR per other DiVA series. An optional
+# corpus.json in the directory holds its settings (see readCorpusSettings).
+
+searchLimit = int(os.environ.get('FATABUREN_SEARCH_LIMIT', 50))  # options returned by the dropdown search
+detailLimit = int(os.environ.get('FATABUREN_DETAIL_LIMIT', 400))  # max articles drawn one by one
+relatedLimit = 30  # bars in the related keywords/authors charts
+relatedMinCount = 2  # PMI only counts keywords found together in at least this many articles
+
+
+def findCorpora(defaultName, defaultDirectory, corporaDirectory):
+    # corpus name -> directory, for the default corpus and every prepared subdirectory of corporaDirectory
+    corpora = {defaultName: defaultDirectory}
+    if corporaDirectory and os.path.isdir(corporaDirectory):
+        for entry in sorted(os.scandir(corporaDirectory), key=lambda entry: entry.name):
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, 'fataburen_articles_diva_processed.csv')):
+                corpora[entry.name] = entry.path
+    return corpora
+
+
+def estimateMemory(value):
+    # approximate bytes held by loaded data: frames, arrays and the dicts/lists holding them
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes + (sum(len(str(item)) + 50 for item in value) if value.dtype == object else 0)
+    if isinstance(value, dict):
+        return sum(100 + estimateMemory(key) + estimateMemory(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(8 + estimateMemory(item) for item in value)
+    if isinstance(value, str):
+        return 50 + len(value)
+    return 32
+
+
+class Corpus:
+    # prepared data and indexes of one corpus
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self.settings = readCorpusSettings(directory)
+
+        # load prepared article data (page count and NBN filter already applied by prepare_data.py),
+        # with the repeated author and keyword lists as categorical codes
+        articleData = compactData(readPreparedData(self.getPath('fataburen_articles_diva_processed.csv'), articleColumns), ['Name', 'Keywords'])
+        textIndex, fullText = readTextIndex(self.getPath('fataburen_articles_diva_processed.csv'), articleData)
+        self.searchPlaceholder = 'Search titles and abstracts' if fullText else 'Search titles (run prepare_data.py to search abstracts)'
+
+        # articles are kept sorted by year (in export order within a year), so the articles of a
+        # range of years are one slice of rows, found by binary search in yearStart
+        yearOrder = np.argsort(articleData['Year'].to_numpy(), kind='mergesort')
+        self.articleData = articleData.iloc[yearOrder].reset_index(drop=True)
+        self.textIndex = reorderTextIndex(textIndex, yearOrder)
+        self.dataVersion = os.path.getmtime(self.getPath('fataburen_articles_diva_processed.csv'))  # results of older data are never reused
+
+        # PID -> row position, for the details of clicked articles; an export listing an article twice
+        # (e.g. overlapping harvested pages) would make the PIDs non-unique, so only the first row is indexed
+        self.articleRows = np.flatnonzero(~self.articleData['PID'].duplicated().to_numpy())
+        self.articlePids = pd.Index(self.articleData['PID'].to_numpy()[self.articleRows])
+
+        # inverted indexes (token -> row positions) used by the Explore filters
+        self.keywordIndex = buildTokenIndex(self.articleData, 'Keywords')
+        self.authorIndex = buildTokenIndex(self.articleData, 'Name')
+
+        self.authorsData = compactData(readPreparedData(self.getPath('fataburen_authors.csv'), authorColumns), ['EarliestArticle', 'LatestArticle'])
+        self.keywordsData = compactData(readPreparedData(self.getPath('fataburen_keywords.csv'), keywordColumns), ['EarliestArticle', 'LatestArticle'])
+        self.authorIds = {author: authorId for authorId, author in enumerate(self.authorsData['Name'])}
+        self.keywordIds = {keyword: keywordId for keywordId, keyword in enumerate(self.keywordsData['Keyword'])}
+
+        # type-ahead search for the dropdowns
+        self.keywordSearch = buildSearchIndex(self.keywordsData['Keyword'], self.keywordsData['ArticlesTotal'])
+        self.authorSearch = buildSearchIndex(self.authorsData['Name'], self.authorsData['ArticlesTotal'])
+
+        # author -> keyword edges, sorted by author id so each author's keywords are one slice,
+        # and read in keyword order through a permutation for the related keywords view
+        self.authorKeywordData = readPreparedData(self.getPath('fataburen_authors_keywords.csv'), authorKeywordColumns)
+        self.authorKeywordStart = np.searchsorted(self.authorKeywordData['AuthorId'].to_numpy(), np.arange(len(self.authorsData)+1))
+        self.keywordAuthorOrder = np.argsort(self.authorKeywordData['KeywordId'].to_numpy(), kind='mergesort')
+        self.keywordAuthorStart = np.searchsorted(self.authorKeywordData['KeywordId'].to_numpy()[self.keywordAuthorOrder], np.arange(len(self.keywordsData)+1))
+
+        # keyword co-occurrences (sparse keyword x keyword rows)
+        self.keywordKeywordData = readPreparedData(self.getPath('fataburen_keywords_keywords.csv'), keywordKeywordColumns)
+        self.keywordKeywordStart = np.searchsorted(self.keywordKeywordData['KeywordId'].to_numpy(), np.arange(len(self.keywordsData)+1))
+
+        # year x keyword and year x author cubes (article counts and page sums); broad Explore
+        # selections are drawn as one bar per year from these, and the trends view slices them
+        self.firstYear, self.lastYear = getYearSpan(self.articleData['Year'])
+        self.years = np.arange(self.firstYear, self.lastYear+1)
+        self.articleYearBins = self.articleData['Year'].to_numpy().astype(np.int64) - self.firstYear
+        self.yearStart = np.searchsorted(self.articleYearBins, np.arange(len(self.years)+1))  # first row of each year
+        self.articlePages = np.nan_to_num(self.articleData['Pages'].to_numpy(dtype=float))
+        cubes = readYearCubes(self.getPath(yearCubePath), [self.getPath('fataburen_authors.csv'), self.getPath('fataburen_keywords.csv')], self.articleData, self.authorsData['Name'], self.keywordsData['Keyword'], self.firstYear, self.lastYear)
+        self.keywordArticleCube, self.keywordPageCube = cubes['keywordArticles'], cubes['keywordPages']
+        self.authorArticleCube, self.authorPageCube = cubes['authorArticles'], cubes['authorPages']
+
+        self.title = self.settings.get('title', name.capitalize() + ' Articles' + (' ' + str(self.firstYear) + '–' + str(self.lastYear) if len(self.years) else ''))
+        self.description = self.settings.get('description', 'Explore the content of ' + name.capitalize() + '.')
+        self.exportUrl = self.settings.get('exportUrl')
+        self.pdfUrl = self.settings.get('pdfUrl', defaultPdfUrl)
+
+        # display orders of the statistics views as row positions, instead of sorted copies of the tables
+        self.statisticsRowOrders = {(view, order): getStatisticsOrder(view, self.authorsData, self.keywordsData, order) for view in statisticsViews for order in statisticsOrders}
+        self.statisticsFigures = {}  # first pages of the statistics views, loaded (or built) on the first visit
+        self.memory = estimateMemory(vars(self))
+
+    def getPath(self, fileName):
+        return os.path.join(self.directory, fileName)
+
+    def getArticle(self, pid):
+        # fields of the article with this PID (missing values as ''), None when it is not in the corpus
+        position = self.articlePids.get_indexer([pid])[0]
+        if position < 0:
+            return None
+        return {column: '' if pd.isna(value) else value for column, value in self.articleData.iloc[self.articleRows[position]].items()}
+
+    def getSearchOptions(self, searchIndex, searchValue, value, allValue=None):
+        # top matches for searchValue, always keeping the selected values so they stay labelled
+        selected = getSelection(value, allValue)
+        matches = searchTokens(searchIndex, searchValue or '', searchLimit)
+        return [{'label': i, 'value': i} for i in selected + [match for match in matches if match not in selected]]
+
+    def getStatisticsFigure(self, name):
+        # first page of a statistics view in the default order
+        if name not in self.statisticsFigures:
+            figurePath = self.getPath(getFigurePath(name))
+            dataPath = self.getPath('fataburen_authors.csv' if name.startswith('authors') else 'fataburen_keywords.csv')
+            if os.path.exists(figurePath) and os.path.getmtime(figurePath) >= os.path.getmtime(dataPath):
+                with open(figurePath, encoding='utf-8') as figureFile:
+                    self.statisticsFigures[name] = json.load(figureFile)
+            else:
+                self.statisticsFigures[name] = json.loads(self.buildStatisticsFigure(name).to_json())
+        return self.statisticsFigures[name]
+
+    def buildStatisticsFigure(self, name, order='top', search='', page=0):
+        return buildStatisticsFigure(name, self.authorsData, self.keywordsData, order, search, page, self.statisticsRowOrders.get((name, order)))
+
+    def getStatisticsRowCount(self, name, order, search):
+        # names in the dropdown search indexes are already normalized
+        names = (self.authorSearch if name.startswith('authors') else self.keywordSearch)['names']
+        if not search:
+            return len(names)
+        search = normalizeText(search)
+        return sum(search in tokenName for tokenName in names)
+
+    def getStatisticsStyle(self, name, order, search, page):
+        rows = min(statisticsPageSize, self.getStatisticsRowCount(name, order, search) - page*statisticsPageSize)
+        return {'height': 150 + max(rows, 1)*15}
+
+    def getStatisticsPageInfo(self, name, order, search, page):
+        rowCount = self.getStatisticsRowCount(name, order, search)
+        if rowCount == 0:
+            return ' No matches '
+        return ' ' + str(page*statisticsPageSize+1) + '–' + str(min(rowCount, (page+1)*statisticsPageSize)) + ' of ' + str(rowCount) + ' '
+
+    def getZoomedYears(self, relayoutData):
+        # years shown after zooming the Explore chart, None when zoomed out again
+        if relayoutData is None or 'xaxis.range[0]' not in relayoutData:
+            return None
+        fromYear = max(self.firstYear, int(math.ceil(float(relayoutData['xaxis.range[0]']))))
+        toYear = min(self.lastYear, int(math.floor(float(relayoutData['xaxis.range[1]']))))
+        return [fromYear, max(fromYear, toYear)]
+
+    def getYearRange(self, yearRange):
+        # [fromYear, toYear] of the Explore year slider within the corpus years, None for all years
+        if not yearRange:
+            return None
+        fromYear = max(self.firstYear, int(min(yearRange)))
+        toYear = min(self.lastYear, int(max(yearRange)))
+        if fromYear == self.firstYear and toYear == self.lastYear:
+            return None
+        return [fromYear, max(fromYear, toYear)]
+
+    def selectYears(self, selectedRows, fromYear, toYear):
+        # rows of selectedRows (sorted) from articles published fromYear-toYear: the year range is the
+        # rows yearStart[fromYear]..yearStart[toYear+1], intersected by binary search
+        start, end = self.yearStart[fromYear-self.firstYear], self.yearStart[toYear-self.firstYear+1]
+        return selectedRows[np.searchsorted(selectedRows, start):np.searchsorted(selectedRows, end)]
+
+    def selectArticles(self, keywords, authors, query, yearRange):
+        # sorted rows of the articles matching the Explore selection (keywords OR'ed, authors OR'ed,
+        # all words of the text query, within yearRange), and the text matches best first
+        selectedRows = np.arange(len(self.articleData))
+        if keywords:
+            selectedRows = selectByTokens(self.keywordIndex, keywords)
+        if authors:
+            selectedRows = np.intersect1d(selectedRows, selectByTokens(self.authorIndex, authors), assume_unique=True)
+        if yearRange is not None:
+            selectedRows = self.selectYears(selectedRows, yearRange[0], yearRange[1])
+        matchingRows = np.array([], dtype=np.int64)
+        if getSearchTerms(query or ''):
+            matchingRows = searchText(self.textIndex, query)[0]
+            matchingRows = matchingRows[np.isin(matchingRows, selectedRows)]
+            selectedRows = np.sort(matchingRows)
+        return selectedRows, matchingRows
+
+    def getSelectionTotals(self, column, rows):
+        # articles, pages and first/last year per author or keyword (column Name or Keywords) of the articles in rows
+        articles = self.articleData.iloc[rows]
+        tokens = articles[column].astype(object).str.split(';').explode().dropna()
+        tokens = pd.DataFrame({'Token': tokens.to_numpy(), 'Row': tokens.index.to_numpy()}).drop_duplicates()
+        tokens['Pages'] = self.articlePages[tokens['Row'].to_numpy()]
+        tokens['Year'] = self.articleData['Year'].to_numpy()[tokens['Row'].to_numpy()]
+        totals = tokens.groupby('Token').agg(ArticlesTotal=('Row', 'size'), PagesTotal=('Pages', 'sum'), EarliestYear=('Year', 'min'), LatestYear=('Year', 'max'))
+        totals = totals.rename_axis('Name' if column == 'Name' else 'Keyword').reset_index()
+        return totals.sort_values(['ArticlesTotal', totals.columns[0]], ascending=[False, True], kind='mergesort')
+
+    def getYearTotals(self, keywords, authors, terms, selectedRows):
+        # article counts and page sums per year; single-token selections come straight from the cubes
+        if not keywords and not authors and not terms:
+            return np.bincount(self.articleYearBins, minlength=len(self.years)), np.bincount(self.articleYearBins, weights=self.articlePages, minlength=len(self.years))
+        if len(keywords) == 1 and not authors and not terms and keywords[0] in self.keywordIds:
+            return self.keywordArticleCube[self.keywordIds[keywords[0]]], self.keywordPageCube[self.keywordIds[keywords[0]]]
+        if len(authors) == 1 and not keywords and not terms and authors[0] in self.authorIds:
+            return self.authorArticleCube[self.authorIds[authors[0]]], self.authorPageCube[self.authorIds[authors[0]]]
+        yearBins = self.articleYearBins[selectedRows]
+        return np.bincount(yearBins, minlength=len(self.years)), np.bincount(yearBins, weights=self.articlePages[selectedRows], minlength=len(self.years))
+
+    def getTrends(self, keywords, authors, measure, binSize):
+        # articles or pages per binSize years of each selected keyword and author, sliced from the cubes
+        binStarts = self.years // binSize * binSize
+        firstBins = np.flatnonzero(np.r_[True, binStarts[1:] != binStarts[:-1]])
+        trends = {'Year': [], 'Value': [], 'Name': [], 'Type': []}
+        for names, ids, cubes, kind in [(keywords, self.keywordIds, (self.keywordArticleCube, self.keywordPageCube), 'Keyword'), (authors, self.authorIds, (self.authorArticleCube, self.authorPageCube), 'Author')]:
+            names = [name for name in names if name in ids]
+            if not names:
+                continue
+            cube = cubes[0] if measure == 'articles' else cubes[1]
+            values = np.add.reduceat(cube[[ids[name] for name in names]], firstBins, axis=1)
+            trends['Year'].append(np.tile(binStarts[firstBins], len(names)))
+            trends['Value'].append(values.ravel())
+            trends['Name'].append(np.repeat(names, len(firstBins)))
+            trends['Type'].append(np.repeat(kind, len(names)*len(firstBins)))
+        return {column: np.concatenate(parts) if parts else [] for column, parts in trends.items()}
+
+    def countSelectedTokens(self, rows, column, tokenIds):
+        # articles among rows (row positions) per token of column, each article counted once per
+        # token, as a Series indexed by token id (ids from tokenIds)
+        tokens = self.articleData[column].iloc[rows].astype(object).str.split(';').explode().dropna()
+        pairs = pd.DataFrame({'Row': tokens.index.to_numpy(), 'TokenId': tokens.map(tokenIds).to_numpy()}).dropna().drop_duplicates()
+        counts = pairs['TokenId'].astype(np.int64).value_counts(sort=False).sort_index()
+        return counts.rename_axis(None).astype(np.int64)
+
+    def getRelatedKeywords(self, keywordIdList, score):
+        # articles shared by the selected keywords (any of them) and every other keyword, scored;
+        # for one keyword its co-occurrence row, for several the keywords of the union of their
+        # articles, so an article with several of the selected keywords is only counted once
+        selectedRows = selectByTokens(self.keywordIndex, self.keywordsData['Keyword'].to_numpy()[keywordIdList]) if keywordIdList else np.array([], dtype=np.int64)
+        if len(keywordIdList) == 1:
+            rows = self.keywordKeywordData.iloc[self.keywordKeywordStart[keywordIdList[0]]:self.keywordKeywordStart[keywordIdList[0]+1]]
+            together = pd.Series(rows['Count'].to_numpy(), index=rows['RelatedId'].to_numpy())
+        else:
+            together = self.countSelectedTokens(selectedRows, 'Keywords', self.keywordIds)
+        together = together[~together.index.isin(keywordIdList)]
+
+        selectedArticles = len(selectedRows)
+        relatedArticles = self.keywordsData['ArticlesTotal'].to_numpy()[together.index.to_numpy()]
+        counts = together.to_numpy().astype(float)
+        if score == 'pmi':
+            scores = np.log2(counts*len(self.articleData) / (selectedArticles*relatedArticles))
+            scores[counts < relatedMinCount] = np.nan
+        elif score == 'jaccard':
+            scores = counts / (selectedArticles + relatedArticles - counts)
+        else:
+            scores = counts
+
+        related = pd.DataFrame({'Keyword': self.keywordsData['Keyword'].to_numpy()[together.index.to_numpy()], 'Score': scores, 'Articles': together.to_numpy()})
+        related = related.dropna().sort_values(['Score', 'Articles'], ascending=False, kind='mergesort')
+        return related.head(relatedLimit)
+
+    def getRelatedAuthors(self, keywordIdList):
+        # authors with most articles among those of the selected keywords (each article counted once)
+        if len(keywordIdList) == 1:
+            edges = self.authorKeywordData.iloc[self.keywordAuthorOrder[self.keywordAuthorStart[keywordIdList[0]]:self.keywordAuthorStart[keywordIdList[0]+1]]]
+            authorCounts = pd.Series(edges['Count'].to_numpy(), index=edges['AuthorId'].to_numpy())
+        else:
+            selectedRows = selectByTokens(self.keywordIndex, self.keywordsData['Keyword'].to_numpy()[keywordIdList]) if keywordIdList else np.array([], dtype=np.int64)
+            authorCounts = self.countSelectedTokens(selectedRows, 'Name', self.authorIds)
+        authorCounts = authorCounts.sort_index().sort_values(ascending=False, kind='mergesort').head(relatedLimit)
+        return pd.DataFrame({'Author': self.authorsData['Name'].to_numpy()[authorCounts.index.to_numpy()], 'Count': authorCounts.to_numpy()})
+
+
+class CorpusCache:
+    # Corpora loaded on first use. When the loaded corpora are estimated to use more than
+    # memoryBudget bytes, the least recently used ones are dropped (the last one used is kept).
+    # A corpus is loaded holding only its own lock, so requests for other (loaded) corpora are
+    # not kept waiting, and concurrent first requests for one corpus load it once.
+
+    def __init__(self, directories, memoryBudget):
+        self.directories = directories
+        self.memoryBudget = memoryBudget
+        self.corpora = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # guards corpora and the counters
+        self.loadLocks = {name: threading.Lock() for name in directories}
+
+    def get(self, name):
+        corpus = self.getLoaded(name)
+        if corpus is not None or name not in self.directories:
+            return corpus
+        with self.loadLocks[name]:
+            corpus = self.getLoaded(name)  # loaded by another thread while this one waited
+            if corpus is not None:
+                return corpus
+            corpus = Corpus(name, self.directories[name])
+            logger.info('Loaded corpus %s (%d articles, about %d MB)', name, len(corpus.articleData), corpus.memory // 2**20)
+            with self.lock:
+                self.loads += 1
+                self.corpora[name] = corpus
+                while len(self.corpora) > 1 and self.getMemory() > self.memoryBudget:
+                    evicted, evictedCorpus = self.corpora.popitem(last=False)
+                    self.evictions += 1
+                    logger.info('Unloaded corpus %s (about %d MB)', evicted, evictedCorpus.memory // 2**20)
+            return corpus
+
+    def getLoaded(self, name):
+        with self.lock:
+            if name in self.corpora:
+                self.corpora.move_to_end(name)
+                return self.corpora[name]
+        return None
+
+    def getMemory(self):
+        return sum(corpus.memory for corpus in self.corpora.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'corpora': list(self.directories),
+                'loaded': {name: corpus.memory for name, corpus in self.corpora.items()},
+                'memory': self.getMemory(),
+                'memoryBudget': self.memoryBudget,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
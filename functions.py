@@ -1,6 +1,25 @@
 from collections import Counter
+import json
+import os
+import re
+import unicodedata
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.io as pio
+
+# Columns (and dtypes) of the prepared tables that the app actually uses
+
+articleColumns = {'Name': object, 'PID': 'int32', 'Title': object, 'Keywords': object, 'Pages': 'float32', 'Year': 'int16', 'NBN': object}
+authorColumns = {'Name': object, 'ArticlesTotal': 'int32', 'PagesTotal': 'float32', 'EarliestArticle': object, 'LatestArticle': object, 'ArticleMean': 'float32'}
+keywordColumns = {'Keyword': object, 'ArticlesTotal': 'int32', 'PagesTotal': 'float32', 'EarliestArticle': object, 'LatestArticle': object, 'ArticleMean': 'float32'}
+
+# Edge tables; ids are row positions in fataburen_authors.csv / fataburen_keywords.csv
+
+authorKeywordColumns = {'AuthorId': 'int32', 'KeywordId': 'int32', 'Count': 'int32'}
+authorYearColumns = {'AuthorId': 'int32', 'Year': 'int16'}
+keywordYearColumns = {'KeywordId': 'int32', 'Year': 'int16'}
+keywordKeywordColumns = {'KeywordId': 'int32', 'RelatedId': 'int32', 'Count': 'int32'}
 
 
 def createTokenCount(wordList, stopWordList):
@@ -41,15 +60,385 @@ def getTokenCountAsData(dataframe, column, columnName, stopWordList):
     return tokenCount
 
 
+def getSelection(value, allValue):
+    # dropdown value -> sorted unique tokens, [] when nothing is selected
+    if value is None or value == allValue:  # the dropdowns start with the column name as "Select all" value
+        return []
+    if isinstance(value, str):
+        value = [value]
+    return sorted(set(value))
+
+
+def buildTokenIndex(dataframe, column):
+    # inverted index: token -> sorted array of row positions (posting list) in dataframe
+    tokens = dataframe[column].reset_index(drop=True).str.split(';').explode().dropna()
+    codes, uniqueTokens = pd.factorize(tokens)
+    rows = tokens.index.to_numpy()
+    order = np.lexsort((rows, codes))
+    codes, rows = codes[order], rows[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])  # drop tokens repeated within a row
+    codes, rows = codes[first], rows[first]
+    return dict(zip(uniqueTokens, np.split(rows, np.searchsorted(codes, np.arange(1, len(uniqueTokens))))))
+
+
+def selectByTokens(tokenIndex, tokens):
+    # union of the posting lists of all tokens (OR), as sorted unique row positions
+    postings = [tokenIndex[token] for token in tokens if token in tokenIndex]
+    if not postings:
+        return np.array([], dtype=np.int64)
+    return np.unique(np.concatenate(postings))
+
+
+def normalizeText(text):
+    # casefolded and without diacritics (Å -> a, é -> e), for accent-insensitive search
+    return ''.join(c for c in unicodedata.normalize('NFKD', text.casefold()) if not unicodedata.combining(c))
+
+
+swedishLetters = str.maketrans({'å': '{', 'ä': '|', 'æ': '|', 'ö': '}', 'ø': '}', 'ü': 'y'})  # the characters after z
+
+
+def getCollationKey(text):
+    # casefolded sort key in Swedish letter order: other accents ignored (é -> e), å, ä, ö after z
+    return normalizeText(text.casefold().translate(swedishLetters))
+
+
+def buildSearchIndex(tokens, counts):
+    # type-ahead index: trigram -> token ids, plus word prefixes for queries shorter than a trigram
+    names = [normalizeText(token) for token in tokens]
+    trigrams = {}
+    prefixes = {}
+    for tokenId, name in enumerate(names):
+        for trigram in set(name[i:i+3] for i in range(len(name)-2)):
+            trigrams.setdefault(trigram, []).append(tokenId)
+        for word in set(re.findall(r'\w+', name)):
+            for prefix in set([word[:1], word[:2]]):
+                prefixes.setdefault(prefix, []).append(tokenId)
+    trigrams = {trigram: np.array(tokenIds, dtype=np.int32) for trigram, tokenIds in trigrams.items()}
+    prefixes = {prefix: np.array(tokenIds, dtype=np.int32) for prefix, tokenIds in prefixes.items()}
+    return {'tokens': list(tokens), 'names': names, 'counts': np.asarray(counts), 'trigrams': trigrams, 'prefixes': prefixes}
+
+
+def searchTokens(searchIndex, query, limit):
+    # tokens matching query, names starting with it first, then by article count
+    query = normalizeText(query).strip()
+    names = searchIndex['names']
+    counts = searchIndex['counts']
+    if not query:
+        matches = range(len(names))
+    elif len(query) < 3:
+        matches = searchIndex['prefixes'].get(query, np.array([], dtype=np.int32)).tolist()
+    else:
+        postings = sorted((searchIndex['trigrams'].get(query[i:i+3], np.array([], dtype=np.int32)) for i in range(len(query)-2)), key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        matches = [tokenId for tokenId in candidates.tolist() if query in names[tokenId]]  # trigrams may match out of order
+    matches = sorted(matches, key=lambda tokenId: (not names[tokenId].startswith(query), -counts[tokenId], names[tokenId]))
+    return [searchIndex['tokens'][tokenId] for tokenId in matches[:limit]]
+
+
+def buildYearCube(dataframe, column, tokens, firstYear, lastYear):
+    # (token x year) article counts and page sums, rows in the order of tokens (e.g. the keywords table)
+    exploded = dataframe[column].reset_index(drop=True).str.split(';').explode().dropna()
+    rows = exploded.index.to_numpy()
+    tokenIds = pd.Index(tokens).get_indexer(exploded)
+    rows, tokenIds = rows[tokenIds >= 0], tokenIds[tokenIds >= 0]
+    pairs = np.unique(rows.astype(np.int64) * len(tokens) + tokenIds)  # tokens repeated within an article count once, as in buildTokenIndex
+    rows, tokenIds = pairs // len(tokens), pairs % len(tokens)
+
+    yearCount = lastYear - firstYear + 1
+    cells = tokenIds * yearCount + dataframe['Year'].to_numpy().astype(np.int64)[rows] - firstYear
+    pages = np.nan_to_num(dataframe['Pages'].to_numpy(dtype=float))[rows]
+    counts = np.bincount(cells, minlength=len(tokens)*yearCount).reshape(len(tokens), yearCount)
+    pageSums = np.bincount(cells, weights=pages, minlength=len(tokens)*yearCount).reshape(len(tokens), yearCount)
+    return counts.astype(np.int32), pageSums.astype(np.float32)
+
+
+# Dense (author x year) and (keyword x year) article counts and page sums, rows in the order of
+# fataburen_authors.csv / fataburen_keywords.csv, written by prepare_data.py
+
+yearCubePath = 'fataburen_year_cubes.npz'
+
+
+def getYearSpan(years):
+    # first and last year of the articles, (0, -1) (no years) for a corpus without articles
+    if len(years) == 0:
+        return 0, -1
+    return int(years.min()), int(years.max())
+
+
+def buildYearCubes(chunks, authors, keywords, firstYear, lastYear):
+    # year cubes of the authors and keywords from article chunks
+    yearCount = lastYear - firstYear + 1
+    cubes = {
+        'years': np.arange(firstYear, lastYear+1).astype(np.int16),
+        'authorArticles': np.zeros((len(authors), yearCount), dtype=np.int32),
+        'authorPages': np.zeros((len(authors), yearCount), dtype=np.float32),
+        'keywordArticles': np.zeros((len(keywords), yearCount), dtype=np.int32),
+        'keywordPages': np.zeros((len(keywords), yearCount), dtype=np.float32)
+    }
+    for chunk in chunks:
+        for entity, column, tokens in [('author', 'Name', authors), ('keyword', 'Keywords', keywords)]:
+            counts, pageSums = buildYearCube(chunk, column, tokens, firstYear, lastYear)
+            cubes[entity + 'Articles'] += counts
+            cubes[entity + 'Pages'] += pageSums
+    return cubes
+
+
+def readYearCubes(cubePath, dataPaths, articleData, authors, keywords, firstYear, lastYear):
+    # cubes written by prepare_data.py, or built from articleData when missing or older than the data files
+    if os.path.exists(cubePath) and all(os.path.getmtime(cubePath) >= os.path.getmtime(dataPath) for dataPath in dataPaths):
+        with np.load(cubePath) as cubeFile:
+            cubes = {name: cubeFile[name] for name in cubeFile.files}
+        if cubes['authorArticles'].shape == (len(authors), lastYear-firstYear+1) and len(cubes['keywordArticles']) == len(keywords) and cubes['years'][0] == firstYear:
+            return cubes
+    return buildYearCubes([articleData], authors, keywords, firstYear, lastYear)
+
+
 def filterByTokens(dataframe, tokens, column):
-    filters = []
-    for token in tokens:
-        filtered = dataframe[dataframe[column].str.contains(token, na=False, regex=False)]
-        filters.append(filtered)  # each token filter is added in a list
-        filteredArticleData = pd.concat(filters)
-    return filteredArticleData
+    # exact token match (OR), each article returned once
+    return dataframe.iloc[selectByTokens(buildTokenIndex(dataframe, column), tokens)]
+
+
+def getFigurePath(name):
+    return 'fataburen_figure_' + name + '.json'
+
+
+# Per corpus settings, read by prepare_data.py and the app from corpus.json in the corpus directory:
+# "title", "description", "nbnFilter" (articles kept are those whose NBN contains it, empty keeps all),
+# "exportUrl" (the DiVA export of the series) and "pdfUrl" (full text link, {pid} is the article's PID)
+
+settingsPath = 'corpus.json'
+defaultPdfUrl = 'http://www.diva-portal.org/smash/get/diva2:{pid}/FULLTEXT01.pdf'
+
+
+def readCorpusSettings(directory):
+    path = os.path.join(directory, settingsPath)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as settingsFile:
+        return json.load(settingsFile)
+
+
+# Statistics views (route without slash), shown statisticsPageSize authors/keywords at a time
+
+statisticsViews = ['authors-articles', 'authors-pages', 'authors-period', 'keywords-articles', 'keywords-pages', 'keywords-period']
+statisticsPageSize = 50
+
+
+statisticsOrders = ['top', 'bottom', 'name']
+
+
+def getStatisticsOrder(name, authorsData, keywordsData, order='top'):
+    # row positions of a statistics view in display order (top of the chart first)
+    entity, statistic = name.split('-')
+    data, nameColumn = (authorsData, 'Name') if entity == 'authors' else (keywordsData, 'Keyword')
+    data = data.reset_index(drop=True)
+    data = data.assign(SortKey=data[nameColumn].map(getCollationKey))  # names in Swedish letter order, case ignored
+
+    if order == 'name':
+        data = data.sort_values(by=['SortKey', nameColumn])
+    elif statistic == 'period':  # earliest first
+        data = data.sort_values(by=['EarliestArticle', 'SortKey', nameColumn], ascending=[order == 'top', True, True])
+    else:
+        column = 'ArticlesTotal' if statistic == 'articles' else 'PagesTotal'
+        data = data.sort_values(by=[column, 'SortKey', nameColumn], ascending=[order != 'top', True, True])
+    return data.index.to_numpy().astype(np.int32)
+
+
+def selectStatisticsRows(name, authorsData, keywordsData, order='top', search='', rowOrder=None):
+    # rows of a statistics view in display order, filtered by search; rowOrder is a precomputed getStatisticsOrder
+    entity = name.split('-')[0]
+    data, nameColumn = (authorsData, 'Name') if entity == 'authors' else (keywordsData, 'Keyword')
+    data = data.iloc[getStatisticsOrder(name, authorsData, keywordsData, order) if rowOrder is None else rowOrder]
+    if search:
+        data = data[data[nameColumn].map(normalizeText).str.contains(normalizeText(search), regex=False)]
+    return data
+
+
+def buildStatisticsFigure(name, authorsData, keywordsData, order='top', search='', page=0, rowOrder=None):
+    # one page of a statistics view, e.g. name 'authors-pages'
+    entity, statistic = name.split('-')
+    nameColumn = 'Name' if entity == 'authors' else 'Keyword'
+    title = entity.capitalize() + ' by ' + {'articles': 'Article Count', 'pages': 'Page Count', 'period': 'Active Period'}[statistic]
+    data = selectStatisticsRows(name, authorsData, keywordsData, order, search, rowOrder)
+    data = data.iloc[page*statisticsPageSize:(page+1)*statisticsPageSize].iloc[::-1]  # plotly draws the first row at the bottom
+
+    if statistic in ['articles', 'pages']:
+        column = 'ArticlesTotal' if statistic == 'articles' else 'PagesTotal'
+        return px.bar(data, x=column, y=nameColumn, orientation='h', title=title, hover_name=nameColumn, hover_data={nameColumn: False})
+
+    data = data.assign(LatestArticleYear=data['LatestArticle'].str.slice(0, 4), ArticleMeanRounded=round(data['ArticleMean'], 0))
+    return px.timeline(
+        data,
+        x_start='EarliestArticle',
+        x_end='LatestArticle',
+        y=nameColumn,
+        title=title,
+        hover_name=nameColumn,
+        hover_data={
+            'EarliestArticle': '|%Y',
+            'LatestArticle': False,
+            'LatestArticleYear': True,
+            'ArticleMeanRounded': True,
+            nameColumn: False
+        }
+    )
+
+
+def getBarTemplate(templateName='plotly'):
+    # the parts of a plotly template that cartesian bar charts use; the full template holds the
+    # defaults of every trace type and is sent again with every figure
+    template = pio.templates[templateName].to_plotly_json()
+    layoutKeys = ['autotypenumbers', 'colorway', 'font', 'hovermode', 'hoverlabel', 'paper_bgcolor', 'plot_bgcolor', 'title', 'xaxis', 'yaxis']
+    return {'layout': {key: value for key, value in template['layout'].items() if key in layoutKeys}, 'data': {'bar': template['data']['bar']}}
 
 
 def filterAuthors(dataframe, authors):
     fig = px.bar(dataframe, x='Year', y='Pages', hover_data=['Title', 'NBN'], barmode='stack')
     return fig
+
+
+def compactData(dataframe, categoryColumns):
+    # repeated text (author lists, keyword lists, dates) as categorical codes: every distinct
+    # string is kept once and each row holds a small integer instead of a pointer to a string object
+    return dataframe.astype({column: 'category' for column in categoryColumns})
+
+
+def getColumnarPath(csvPath):
+    return os.path.splitext(csvPath)[0] + '.feather'
+
+
+def getColumnarFrame(dataframe, columns):
+    columnarData = dataframe[list(columns)].reset_index(drop=True)
+    for column, dtype in columns.items():
+        if dtype is object:  # store text as written to the csv, e.g. lists as their string form
+            columnarData[column] = columnarData[column].where(columnarData[column].isna(), columnarData[column].astype(str))
+    return columnarData.astype(columns)
+
+
+def writeColumnarData(dataframe, csvPath, columns):
+    # typed feather copy of a prepared csv, holding only the columns the app reads
+    try:
+        getColumnarFrame(dataframe, columns).to_feather(getColumnarPath(csvPath))
+    except ImportError:
+        print('pyarrow not installed, skipping', getColumnarPath(csvPath))
+
+
+def writeColumnarChunks(chunks, csvPath, columns):
+    # same as writeColumnarData, one chunk at a time (feather v2 is the arrow ipc file format)
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print('pyarrow not installed, skipping', getColumnarPath(csvPath))
+        return
+
+    schema = pa.schema([(column, pa.string() if dtype is object else pa.from_numpy_dtype(np.dtype(dtype))) for column, dtype in columns.items()])
+    writer = pa.ipc.new_file(getColumnarPath(csvPath), schema)
+    for chunk in chunks:
+        writer.write_table(pa.Table.from_pandas(getColumnarFrame(chunk, columns), schema=schema, preserve_index=False))
+    writer.close()
+
+
+# Full-text index of the articles (title, abstract, notes) for the search box on Explore
+
+textIndexPath = 'fataburen_text_index.npz'
+swedishSuffixes = sorted(['arnas', 'ernas', 'ornas', 'andes', 'arna', 'erna', 'orna', 'ande', 'arne', 'aste', 'ens', 'ern', 'ets', 'het', 'ade', 'are', 'ast', 'an', 'ar', 'er', 'or', 'en', 'at', 'et', 'a', 'e', 's'], key=len, reverse=True)
+
+
+def stemWord(word):
+    # light Swedish stemming, removes the longest inflection suffix that leaves at least three letters
+    for suffix in swedishSuffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def getSearchTerms(text):
+    return [stemWord(word) for word in re.findall(r'[^\W_]+', text.casefold())]
+
+
+def getTextPostings(texts):
+    # (Term, Row, Count) for a Series of texts indexed by article row, and the number of terms per row
+    words = texts.fillna('').str.casefold().str.findall(r'[^\W_]+').explode().dropna()
+    codes, uniqueWords = pd.factorize(words)
+    terms = pd.Series(np.array([stemWord(word) for word in uniqueWords], dtype=object)[codes], index=words.index)
+    postings = terms.groupby([terms.to_numpy(), terms.index.to_numpy()]).size()
+    postings = pd.DataFrame({'Term': postings.index.get_level_values(0), 'Row': postings.index.get_level_values(1), 'Count': postings.to_numpy()})
+    return postings, terms.groupby(level=0).size().reindex(texts.index, fill_value=0)
+
+
+def packTextIndex(postings, termCounts):
+    # postings -> sorted term array with one slice of (row, count) per term, as saved in textIndexPath
+    postings = postings.sort_values(['Term', 'Row'])
+    terms, termStart = np.unique(postings['Term'].to_numpy().astype(str), return_index=True)
+    return {
+        'terms': terms,
+        'termStart': np.append(termStart, len(postings)).astype(np.int64),
+        'rows': postings['Row'].to_numpy().astype(np.int32),
+        'counts': postings['Count'].to_numpy().astype(np.int32),
+        'lengths': termCounts.to_numpy().astype(np.int32)
+    }
+
+
+def packTermPostings(terms, termIds, rows, counts, lengths):
+    # same as packTextIndex for postings given as ids into the sorted array terms; unused terms are dropped
+    used = np.bincount(termIds, minlength=len(terms)) > 0
+    termIds = (np.cumsum(used) - 1)[termIds]
+    order = np.lexsort((rows, termIds))
+    return {
+        'terms': terms[used],
+        'termStart': np.searchsorted(termIds[order], np.arange(used.sum()+1)).astype(np.int64),
+        'rows': rows[order].astype(np.int32),
+        'counts': counts[order].astype(np.int32),
+        'lengths': lengths.astype(np.int32)
+    }
+
+
+def searchText(textIndex, query, k1=1.2, b=0.75):
+    # rows containing all terms of query and their BM25 scores, best first
+    lengths = textIndex['lengths']
+    scores = np.zeros(len(lengths))
+    matches = np.zeros(len(lengths), dtype=np.int32)
+    terms = sorted(set(getSearchTerms(query)))
+    for term in terms:
+        termId = np.searchsorted(textIndex['terms'], term)
+        if termId == len(textIndex['terms']) or textIndex['terms'][termId] != term:
+            return np.array([], dtype=np.int64), np.array([])
+        postingSlice = slice(textIndex['termStart'][termId], textIndex['termStart'][termId+1])
+        rows, counts = textIndex['rows'][postingSlice], textIndex['counts'][postingSlice]
+        idf = np.log(1 + (len(lengths) - len(rows) + 0.5) / (len(rows) + 0.5))
+        scores[rows] += idf * counts*(k1+1) / (counts + k1*(1 - b + b*lengths[rows]/max(lengths.mean(), 1)))
+        matches[rows] += 1
+    rows = np.flatnonzero(matches == len(terms)) if terms else np.array([], dtype=np.int64)
+    rows = rows[np.argsort(-scores[rows], kind='mergesort')]
+    return rows, scores[rows]
+
+
+def readTextIndex(csvPath, articleData):
+    # index written by prepare_data.py next to csvPath (titles, abstracts and notes), or an index of the
+    # titles when it is missing or outdated; returns the index and whether it is the full one
+    indexPath = os.path.join(os.path.dirname(csvPath), textIndexPath)
+    if os.path.exists(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(csvPath):
+        with np.load(indexPath) as textIndex:
+            return {name: textIndex[name] for name in textIndex.files}, True
+    return packTextIndex(*getTextPostings(articleData['Title'])), False
+
+
+def reorderTextIndex(textIndex, order):
+    # the index with the articles reordered: row order[i] becomes row i
+    newRows = np.empty(len(order), dtype=np.int32)
+    newRows[order] = np.arange(len(order), dtype=np.int32)
+    return dict(textIndex, rows=newRows[textIndex['rows']], lengths=textIndex['lengths'][order])
+
+
+def readPreparedData(csvPath, columns):
+    # prefer the feather copy written by prepare_data.py, fall back to parsing the csv
+    columnarPath = getColumnarPath(csvPath)
+    if os.path.exists(columnarPath) and os.path.getmtime(columnarPath) >= os.path.getmtime(csvPath):
+        try:
+            return pd.read_feather(columnarPath, columns=list(columns))
+        except ImportError:
+            pass
+    return pd.read_csv(csvPath, usecols=list(columns), dtype=columns)[list(columns)]
@@ -0,0 +1,170 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Downloads a DiVA csvall export page by page into a directory of csv files (page_00000.csv, ...),
+# which prepare_data.py reads as one export (in chunks, one page file per process): python harvest_data.py --prepare
+#
+# Pages are fetched a few at a time until one comes back with fewer rows than the page size. Each
+# page is streamed to disk, and its ETag/Last-Modified are saved in harvest.json, so the next run
+# sends conditional requests and keeps the pages the server reports as not modified.
+#
+# A server that ignores the offset parameter returns the first page over and over, so the harvest
+# also stops at a page with the same ETag or content (sha1) as the page before it, and after maxPages.
+# harvest_stub.py serves an export the same way for testing offline (see test_harvest.py).
+
+exportUrl = 'http://www.diva-portal.org/smash/export.jsf?format=csvall&addFilename=true&aq=[[]]&aqe=[]&aq2=[[{"seriesISSN":"0348-971X","organisationId-Xtra":false},{"publicationTypeCode":["chapter"]}]]&onlyFullText=false&sortOrder=title_sort_asc&sortOrder2=dateIssued_sort_asc'
+manifestName = 'harvest.json'
+defaultMaxPages = 1000
+retryStatuses = {429, 500, 502, 503, 504}
+
+
+def getPageUrl(url, page, pageSize, offsetParameter):
+    # url with the page size and the offset of the first row of page set
+    parts = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if key not in ('noOfRows', offsetParameter)]
+    query += [('noOfRows', str(pageSize)), (offsetParameter, str(page*pageSize))]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def getPagePath(directory, page):
+    return os.path.join(directory, 'page_' + str(page).zfill(5) + '.csv')
+
+
+def countRows(path):
+    # csv records after the header (fields may hold line breaks, so lines are not counted)
+    with open(path, newline='', encoding='utf-8-sig') as pageFile:
+        return max(sum(1 for _ in csv.reader(pageFile)) - 1, 0)
+
+
+def waitBeforeRetry(error, path, attempt, backoff):
+    # Retry-After of the response if given in seconds, else exponential backoff
+    retryAfter = error.headers.get('Retry-After') if isinstance(error, urllib.error.HTTPError) else None
+    delay = int(retryAfter) if retryAfter is not None and retryAfter.isdigit() else backoff * 2**attempt
+    print('Retrying', os.path.basename(path), 'in', delay, 's:', error)
+    time.sleep(delay)
+
+
+def fetchPage(url, path, previous, retries, backoff, timeout):
+    # download url to path; returns the manifest entry of the page (previous when not modified)
+    headers = {'User-Agent': 'fataburen-harvester'}
+    if previous is not None and previous['url'] == url and os.path.exists(path):
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('lastModified'):
+            headers['If-Modified-Since'] = previous['lastModified']
+
+    for attempt in range(retries+1):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                digest = hashlib.sha1()
+                with open(path + '.part', 'wb') as pageFile:
+                    for block in iter(lambda: response.read(2**16), b''):
+                        digest.update(block)
+                        pageFile.write(block)
+                os.replace(path + '.part', path)
+                return {'url': url, 'etag': response.headers.get('ETag'), 'lastModified': response.headers.get('Last-Modified'), 'sha1': digest.hexdigest(), 'rows': countRows(path), 'modified': True}
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return dict(previous, modified=False)
+            if error.code not in retryStatuses or attempt == retries:
+                raise
+            waitBeforeRetry(error, path, attempt, backoff)
+        except (urllib.error.URLError, OSError) as error:  # connection errors and timeouts
+            if attempt == retries:
+                raise
+            waitBeforeRetry(error, path, attempt, backoff)
+
+
+def isRepeated(entry, previousEntry):
+    # whether a page with rows is the same as the page before it (by ETag, or else by content)
+    if entry['rows'] == 0:  # empty pages after the last one are all the same
+        return False
+    if entry.get('etag') and entry['etag'] == previousEntry.get('etag'):
+        return True
+    return entry.get('sha1') is not None and entry['sha1'] == previousEntry.get('sha1')
+
+
+def harvest(url, directory, pageSize, workers, offsetParameter, retries=3, backoff=1, timeout=60, maxPages=defaultMaxPages):
+    # returns the number of pages downloaded or removed, and whether the whole export was harvested
+    os.makedirs(directory, exist_ok=True)
+    manifestPath = os.path.join(directory, manifestName)
+    manifest = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath, encoding='utf-8') as manifestFile:
+            manifest = json.load(manifestFile)
+
+    # at most workers pages in flight; no new pages after the first short (last) page, the first
+    # repeated page (the one before it is the last) or maxPages
+    pages = {}
+    lastPage = None
+    nextPage = 0
+    complete = True
+    with ThreadPoolExecutor(workers) as pool:
+        running = {}
+        while running or (lastPage is None and nextPage < maxPages):
+            while lastPage is None and nextPage < maxPages and len(running) < workers:
+                pageUrl = getPageUrl(url, nextPage, pageSize, offsetParameter)
+                running[pool.submit(fetchPage, pageUrl, getPagePath(directory, nextPage), manifest.get(str(nextPage)), retries, backoff, timeout)] = nextPage
+                nextPage += 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = running.pop(future)
+                pages[page] = future.result()
+                if pages[page]['rows'] < pageSize:
+                    lastPage = page if lastPage is None else min(lastPage, page)
+                for repeated in [page, page+1]:
+                    if repeated-1 in pages and repeated in pages and isRepeated(pages[repeated], pages[repeated-1]) and (lastPage is None or repeated-1 < lastPage):
+                        print('Page', repeated, 'repeats page', repeated-1, '- the server seems to ignore', offsetParameter + ', stopping')
+                        lastPage = repeated-1
+                        complete = False
+    if lastPage is None:
+        print('Stopped after', maxPages, 'pages (--max-pages), the export may be incomplete')
+        lastPage = maxPages-1
+        complete = False
+
+    # pages after the last one (fetched in parallel, or left from a larger earlier harvest) and an
+    # empty last page are removed
+    pages = {page: entry for page, entry in pages.items() if page < lastPage or (page == lastPage and entry['rows'] > 0)}
+    pagePaths = set(getPagePath(directory, page) for page in pages)
+    removed = 0
+    for path in glob.glob(os.path.join(directory, 'page_*.csv')):
+        if path not in pagePaths:
+            os.remove(path)
+            removed += str(int(os.path.basename(path)[5:10])) in manifest
+
+    modified = sum(entry.pop('modified') for entry in pages.values())
+    with open(manifestPath + '.part', 'w', encoding='utf-8') as manifestFile:
+        json.dump({str(page): entry for page, entry in sorted(pages.items())}, manifestFile, indent=1)
+    os.replace(manifestPath + '.part', manifestPath)
+    print(sum(entry['rows'] for entry in pages.values()), 'articles in', len(pages), 'pages,', modified, 'downloaded,', len(pages)-modified, 'not modified and', removed, 'removed')
+    return modified + removed, complete
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download a DiVA csvall export page by page.')
+    parser.add_argument('--url', default=exportUrl, help='export url (without page parameters)')
+    parser.add_argument('--directory', default='harvest', help='directory for the pages and ' + manifestName)
+    parser.add_argument('--page-size', type=int, default=1000, help='rows per page (noOfRows)')
+    parser.add_argument('--offset-parameter', default='startRow', help='query parameter for the first row of a page')
+    parser.add_argument('--workers', type=int, default=4, help='pages downloaded at the same time')
+    parser.add_argument('--max-pages', type=int, default=defaultMaxPages, help='pages downloaded at most')
+    parser.add_argument('--retries', type=int, default=3, help='retries of a page after connection errors and 429/5xx responses')
+    parser.add_argument('--prepare', action='store_true', help='run prepare_data.py on the pages afterwards (skipped when nothing changed)')
+    args = parser.parse_args()
+
+    changes, complete = harvest(args.url, args.directory, args.page_size, args.workers, args.offset_parameter, args.retries, maxPages=args.max_pages)
+    if args.prepare and not complete:
+        sys.exit('Not preparing an incomplete export')
+    if args.prepare and changes:
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prepare_data.py'), args.directory], check=True)
@@ -0,0 +1,92 @@
+import argparse
+import csv
+import hashlib
+import io
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for the DiVA export used by harvest_data.py, serving the rows of a local csv export
+# page by page (noOfRows and startRow), with ETags and 304 responses, so harvests can be tested
+# offline. It can also answer the first requests with 503 (failures) or ignore startRow, as a
+# misbehaving server would:
+#
+#   python harvest_stub.py fataburen_articles_diva.csv --port 8000
+#   python harvest_data.py --url "http://localhost:8000/smash/export.jsf?format=csvall" --page-size 500
+
+
+def readExportRows(path):
+    # header and records of a csv export (fields may hold line breaks)
+    with open(path, newline='', encoding='utf-8-sig') as exportFile:
+        rows = list(csv.reader(exportFile))
+    return rows[0], rows[1:]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            failing = len(server.requests) <= server.failures
+        if failing:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        pageSize = int(query.get('noOfRows', len(server.rows)))
+        start = 0 if server.ignoreOffset else int(query.get(server.offsetParameter, 0))
+        text = io.StringIO()
+        csv.writer(text, lineterminator='\n').writerows([server.header] + server.rows[start:start+pageSize])
+        body = text.getvalue().encode('utf-8')
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if server.etags:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startStubServer(exportPath, port=0, offsetParameter='startRow', ignoreOffset=False, failures=0, etags=True):
+    # serve exportPath in a background thread; returns the server and the export url
+    # (server.requests lists the paths requested, server.shutdown() stops it)
+    server = ThreadingHTTPServer(('localhost', port), StubHandler)
+    server.header, server.rows = readExportRows(exportPath)
+    server.offsetParameter = offsetParameter
+    server.ignoreOffset = ignoreOffset
+    server.failures = failures
+    server.etags = etags
+    server.requests = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://localhost:' + str(server.server_address[1]) + '/smash/export.jsf?format=csvall'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a DiVA csv export page by page, like the DiVA export.')
+    parser.add_argument('export', nargs='?', default='fataburen_articles_diva.csv', help='csv export to serve')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--offset-parameter', default='startRow', help='query parameter for the first row of a page')
+    parser.add_argument('--ignore-offset', action='store_true', help='always serve the first page')
+    parser.add_argument('--failures', type=int, default=0, help='answer the first requests with 503')
+    parser.add_argument('--no-etags', dest='etags', action='store_false', help='send no ETag headers')
+    args = parser.parse_args()
+
+    server, url = startStubServer(args.export, args.port, args.offset_parameter, args.ignore_offset, args.failures, args.etags)
+    print('Serving', args.export, 'at', url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
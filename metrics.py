@@ -0,0 +1,141 @@
+import cProfile
+from contextlib import contextmanager
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+import flask
+
+# Callback instrumentation, exposed in the Prometheus text format by the app at /metrics.
+# Metrics are kept per process, so with several gunicorn workers each scrape sees one worker.
+
+logger = logging.getLogger('fataburen')
+
+secondsBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+bytesBuckets = [1000, 10000, 100000, 1000000, 10000000]
+sizeBuckets = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+class Histogram:
+
+    def __init__(self, name, description, buckets, labelNames):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labelNames = labelNames
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.setdefault(labels, [0]*(len(self.buckets)+2) + [0.0])
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[position] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' histogram']
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                labelText = ','.join(labelName + '="' + str(label).replace('"', '\\"') + '"' for labelName, label in zip(self.labelNames, labels))
+                for position, bound in enumerate(self.buckets):
+                    lines.append(self.name + '_bucket{' + labelText + (',' if labelText else '') + 'le="' + str(bound) + '"} ' + str(series[position]))
+                lines.append(self.name + '_bucket{' + labelText + (',' if labelText else '') + 'le="+Inf"} ' + str(series[-2]))
+                lines.append(self.name + '_count{' + labelText + '} ' + str(series[-2]))
+                lines.append(self.name + '_sum{' + labelText + '} ' + repr(series[-1]))
+        return '\n'.join(lines)
+
+
+callbackSeconds = Histogram('fataburen_callback_seconds', 'Time spent in a callback function.', secondsBuckets, ['callback'])
+phaseSeconds = Histogram('fataburen_callback_phase_seconds', 'Time spent in a phase of a callback (filter, figure, ...).', secondsBuckets, ['callback', 'phase'])
+requestSeconds = Histogram('fataburen_request_seconds', 'Time of a callback request, including serialization of the response.', secondsBuckets, ['callback'])
+serializeSeconds = Histogram('fataburen_serialize_seconds', 'Time between the callback returning and the response being ready.', secondsBuckets, ['callback'])
+responseBytes = Histogram('fataburen_response_bytes', 'Size of callback responses.', bytesBuckets, ['callback'])
+selectionSize = Histogram('fataburen_selection_size', 'Number of selected keywords, authors and articles.', sizeBuckets, ['callback', 'kind'])
+
+histograms = [callbackSeconds, phaseSeconds, requestSeconds, serializeSeconds, responseBytes, selectionSize]
+
+# Sampled profiling: FATABUREN_PROFILE_SAMPLE of the callbacks run under cProfile, and the
+# profiles of those slower than FATABUREN_PROFILE_SLOW seconds are saved in FATABUREN_PROFILE_DIR.
+
+profileSample = float(os.environ.get('FATABUREN_PROFILE_SAMPLE', 0))
+profileSlow = float(os.environ.get('FATABUREN_PROFILE_SLOW', 1))
+profileDirectory = os.environ.get('FATABUREN_PROFILE_DIR', 'profiles')
+
+
+def instrument(name):
+    # decorator for callbacks, place it below @app.callback
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            profile = cProfile.Profile() if profileSample > 0 and random.random() < profileSample else None
+            start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                return function(*args)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                seconds = time.perf_counter() - start
+                callbackSeconds.observe(seconds, name)
+                if flask.has_request_context():
+                    flask.g.callbackName = name
+                    flask.g.callbackEnd = time.perf_counter()
+                if profile is not None and seconds >= profileSlow:
+                    saveProfile(profile, name, seconds)
+        return wrapper
+    return decorator
+
+
+def saveProfile(profile, name, seconds):
+    os.makedirs(profileDirectory, exist_ok=True)
+    path = os.path.join(profileDirectory, name + '-' + time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()) + '.prof')
+    profile.dump_stats(path)
+    logger.warning('Slow callback %s (%.2f s), profile saved to %s', name, seconds, path)
+
+
+@contextmanager
+def phase(callback, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phaseSeconds.observe(time.perf_counter() - start, callback, name)
+
+
+def observeSelection(callback, kind, size):
+    selectionSize.observe(size, callback, kind)
+
+
+def registerEndpoints(server, cacheStats=None):
+    # request timing and payload size of callback requests, and the /metrics endpoint
+    @server.before_request
+    def startTimer():
+        flask.g.requestStart = time.perf_counter()
+
+    @server.after_request
+    def recordRequest(response):
+        name = flask.g.get('callbackName')
+        if flask.request.path.endswith('/_dash-update-component') and name is not None:
+            end = time.perf_counter()
+            requestSeconds.observe(end - flask.g.requestStart, name)
+            serializeSeconds.observe(end - flask.g.callbackEnd, name)
+            if not response.direct_passthrough:
+                responseBytes.observe(response.calculate_content_length() or 0, name)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        text = '\n'.join(histogram.render() for histogram in histograms)
+        if cacheStats is not None:
+            stats = cacheStats()
+            text += '\n# TYPE fataburen_cache_requests_total counter'
+            for result in ['hits', 'diskHits', 'misses']:
+                text += '\nfataburen_cache_requests_total{result="' + result + '"} ' + str(stats[result])
+        return flask.Response(text + '\n', mimetype='text/plain; version=0.0.4')
@@ -1,104 +1,632 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
 
-import math
-import statistics
+from itertools import chain
+
+from reconcile import aliasPath, applyAliases, countAuthorNames, mergeAuthorCounts, readAliases, reconcileAuthors, reviewPath, stripAffiliations, writeAliases, writeReview
+from functions import articleColumns, authorColumns, authorKeywordColumns, authorYearColumns, keywordColumns, keywordKeywordColumns, keywordYearColumns, buildStatisticsFigure, buildYearCube, buildYearCubes, getFigurePath, getTextPostings, getYearSpan, packTermPostings, readCorpusSettings, selectStatisticsRows, statisticsPageSize, settingsPath, statisticsViews, textIndexPath, writeColumnarChunks, writeColumnarData, yearCubePath
+
+# Aggregation runs on exploded (article, token) rows. Every row gets an Order number built from
+# its article row and its position in the ;-separated field, so first-appearance ties can be
+# broken the same way as the Counter.most_common() calls this script used to make.
+
+positionFactor = 2**16  # room for up to 65536 authors/keywords in one article
+rowFactor = positionFactor**2
+
+# Only these columns of the 54 in a DiVA csvall export are read
+exportColumns = {'PID': 'int64', 'Name': object, 'Title': object, 'Keywords': object, 'StartPage': 'float64', 'EndPage': 'float64', 'Year': 'int64', 'NBN': object, 'LastUpdated': object, 'Abstract': object, 'Notes': object}
+
+processedPath = 'fataburen_articles_diva_processed.csv'
+processedColumns = ['Name', 'PID', 'Title', 'Keywords', 'StartPage', 'EndPage', 'Pages', 'Year', 'NBN']
+stateColumns = ['PID', 'LastUpdated', 'Name', 'Keywords', 'Year', 'Pages']
+statePath = 'fataburen_state.pkl'  # articles, partial aggregates and figure keys of the last run, for --incremental
+
+allOutputs = {'articles', 'authors', 'keywords', 'authorsKeywords', 'authorsYears', 'keywordsYears', 'keywordsKeywords', 'yearCubes'}
+figureColumns = ['Name', 'Keyword', 'ArticlesTotal', 'PagesTotal', 'EarliestArticle', 'LatestArticle', 'ArticleMean']
+
+
+def selectArticles(articleData, nbnFilter):
+    # clean data by removing duplicate articles added by other institutions: only the articles whose
+    # NBN contains nbnFilter (the publisher's part of it, e.g. 'nordiskamuseet') are kept, all when empty
+    if not nbnFilter:
+        return articleData.copy()
+    return articleData[articleData['NBN'].str.contains(nbnFilter, regex=False, na=False)].copy()
+
+
+def cleanArticleData(articleData, aliases, nbnFilter):
+    articleData['Pages'] = articleData['EndPage']-articleData['StartPage']+1  # add pagecount as separate column in dataframe
+
+    articleData = selectArticles(articleData, nbnFilter)
+
+    articleData['Name'] = applyAliases(stripAffiliations(articleData['Name']), aliases)  # see reconcile.py
+    return articleData.reset_index(drop=True)
+
+
+def getExportPaths(exports):
+    # export files in the given order, directories replaced by the csv files in them (sorted by name)
+    paths = []
+    for export in exports:
+        paths += sorted(glob.glob(os.path.join(export, '*.csv'))) if os.path.isdir(export) else [export]
+    return paths
+
+
+def mapShards(function, argumentList, jobs):
+    # function(*arguments) for each shard, in a process pool when there are several shards and jobs
+    if jobs > 1 and len(argumentList) > 1:
+        with ProcessPoolExecutor(min(jobs, len(argumentList))) as pool:
+            return list(pool.map(function, *zip(*argumentList)))
+    return [function(*arguments) for arguments in argumentList]
+
+
+def readExport(paths, chunksize, aliases, nbnFilter):
+    # cleaned articles of the export files, one chunk at a time; index is the running position among kept articles
+    offset = 0
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=list(exportColumns), dtype=exportColumns, chunksize=chunksize):
+            chunk = cleanArticleData(chunk, aliases, nbnFilter)
+            chunk.index += offset
+            offset += len(chunk)
+            yield chunk
+
+
+def countExportNames(path, chunksize, nbnFilter):
+    authorCounts = [countAuthorNames(pd.DataFrame(columns=['Name', 'Keywords'], dtype=str))]  # only used when there are no chunks
+    for chunk in pd.read_csv(path, usecols=['Name', 'Keywords', 'NBN'], dtype=str, chunksize=chunksize):
+        chunk = selectArticles(chunk, nbnFilter)
+        chunk['Name'] = stripAffiliations(chunk['Name'])
+        authorCounts.append(countAuthorNames(chunk))
+    return mergeAuthorCounts(authorCounts)
+
+
+def readAuthorAliases(paths, chunksize, reconcile, jobs, nbnFilter):
+    # saved author aliases, extended with the new author strings of the export unless reconcile is False
+    aliases = readAliases()
+    if reconcile:
+        nameCounts, nameKeywords = mergeAuthorCounts(mapShards(countExportNames, [(path, chunksize, nbnFilter) for path in paths], jobs))
+        if nameCounts.index.isin(list(aliases)).all():  # no new author strings, the mapping would stay the same
+            return aliases
+        aliases, candidates = reconcileAuthors(nameCounts, nameKeywords, aliases)
+        writeAliases(aliases)
+        writeReview(candidates)
+        print(len(aliases), 'author names,', len(set(aliases.values())), 'authors after reconciliation,', len(candidates), 'sound-alike authors to review in', reviewPath)
+    return aliases
+
+
+def explodeTokens(articleData, column, tokenName):
+    # one row per (article, token); Row is the article's index label in articleData
+    tokens = pd.Series(articleData[column].to_numpy()).str.split(';').explode()
+    tokens = tokens[tokens.notna() & (tokens != 'nan')]
+    articles = tokens.index.to_numpy()
+    rows = articleData.index.to_numpy()[articles]
+    positions = tokens.groupby(level=0).cumcount().to_numpy()
+    return pd.DataFrame({
+        tokenName: tokens.to_numpy(),
+        'Row': rows,
+        'Position': positions,
+        'Order': rows.astype(np.int64)*rowFactor + positions*positionFactor,
+        'Year': articleData['Year'].to_numpy()[articles].astype(np.int64),
+        'Pages': articleData['Pages'].to_numpy()[articles]
+    })
+
+
+def summarizeTokens(tokenRows, tokenName):
+    tokenRows = tokenRows.sort_values('Order', kind='mergesort')
+    grouped = tokenRows.groupby(tokenName, sort=False)
+    summary = grouped.agg(
+        ArticlesTotal=('Order', 'size'),
+        PagesTotal=('Pages', 'sum'),
+        EarliestYear=('Year', 'min'),
+        LatestYear=('Year', 'max'),
+        YearSum=('Year', 'sum'),
+        FirstSeen=('Order', 'min'))
+
+    # article years per token, in article order
+    codes = pd.Index(summary.index).get_indexer(tokenRows[tokenName])
+    order = np.argsort(codes, kind='mergesort')
+    years = tokenRows['Year'].to_numpy().astype(float)[order].tolist()
+    summary['Years'] = splitIntoLists(codes[order], years, len(summary))
+    return summary
+
+
+def splitIntoLists(ids, values, count):
+    # values sorted by ids -> one list per id 0..count-1
+    boundaries = np.searchsorted(ids, np.arange(count+1)).tolist()
+    lists = np.empty(count, dtype=object)  # filled one by one so numpy never turns the lists into a 2-D array
+    for position in range(count):
+        lists[position] = values[boundaries[position]:boundaries[position+1]]
+    return lists
+
+
+def aggregateArticles(articleData):
+    # partial aggregates for a block of cleaned articles, see mergePartials
+    authorRows = explodeTokens(articleData, 'Name', 'Author')
+    keywordRows = explodeTokens(articleData, 'Keywords', 'Keyword')
+
+    pairRows = authorRows[['Author', 'Row', 'Position']].merge(keywordRows[['Keyword', 'Row', 'Position']], on='Row', suffixes=('Author', 'Keyword'))
+    pairRows['Order'] = pairRows['Row'].astype(np.int64)*rowFactor + pairRows['PositionAuthor']*positionFactor + pairRows['PositionKeyword']
+    pairs = pairRows.groupby(['Author', 'Keyword'], sort=False).agg(Count=('Order', 'size'), FirstSeen=('Order', 'min'))
+
+    # keyword co-occurrence: articles having both keywords, stored in both directions
+    keywordArticles = keywordRows[['Keyword', 'Row']].drop_duplicates()
+    cooccurrences = keywordArticles.merge(keywordArticles, on='Row', suffixes=('', 'Related'))
+    cooccurrences = cooccurrences[cooccurrences['Keyword'] != cooccurrences['KeywordRelated']]
+    keywordPairs = cooccurrences.groupby(['Keyword', 'KeywordRelated'], sort=False).agg(Count=('Row', 'size'))
+
+    return {
+        'authors': summarizeTokens(authorRows, 'Author'),
+        'keywords': summarizeTokens(keywordRows, 'Keyword'),
+        'pairs': pairs,
+        'keywordPairs': keywordPairs
+    }
+
+
+def mergePartials(partials):
+    # partials must be given in article order; merging is associative
+    if len(partials) == 1:
+        return partials[0]
+
+    merged = {}
+    for part in ['authors', 'keywords']:
+        combined = pd.concat([partial[part] for partial in partials])
+        summary = combined.groupby(level=0, sort=False).agg({'ArticlesTotal': 'sum', 'PagesTotal': 'sum', 'EarliestYear': 'min', 'LatestYear': 'max', 'YearSum': 'sum', 'FirstSeen': 'min'})
+        # only tokens found in several partials need their year lists joined
+        repeated = combined.index.duplicated(keep=False)
+        joinedYears = combined['Years'][repeated].groupby(level=0, sort=False).agg(lambda lists: list(chain.from_iterable(lists)))
+        summary['Years'] = pd.concat([combined['Years'][~repeated], joinedYears]).reindex(summary.index)
+        merged[part] = summary
+    merged['pairs'] = pd.concat([partial['pairs'] for partial in partials]).groupby(level=[0, 1], sort=False).agg({'Count': 'sum', 'FirstSeen': 'min'})
+    merged['keywordPairs'] = pd.concat([partial['keywordPairs'] for partial in partials]).groupby(level=[0, 1], sort=False).agg({'Count': 'sum'})
+    return merged
+
+
+def finalizeAggregates(partial):
+    # most used first, ties in order of first appearance
+    authors = partial['authors'].sort_values(['ArticlesTotal', 'FirstSeen'], ascending=[False, True])
+    keywords = partial['keywords'].sort_values(['ArticlesTotal', 'FirstSeen'], ascending=[False, True])
+
+    pairs = partial['pairs'].reset_index()
+    pairs['AuthorId'] = pd.Index(authors.index).get_indexer(pairs['Author'])
+    pairs['KeywordId'] = pd.Index(keywords.index).get_indexer(pairs['Keyword'])
+
+    authorKeywordData = pairs.sort_values(['AuthorId', 'Count', 'FirstSeen'], ascending=[True, False, True])
+    keywordAuthorData = pairs.sort_values(['KeywordId', 'Count', 'FirstSeen'], ascending=[True, False, True])
+
+    keywordsUsed = list(zip(authorKeywordData['Keyword'].tolist(), authorKeywordData['Count'].tolist()))
+    authorsUsed = list(zip(keywordAuthorData['Author'].tolist(), keywordAuthorData['Count'].tolist()))
+
+    authorData = summaryToOutput(authors, 'Name')
+    authorData['KeywordsUsed'] = splitIntoLists(authorKeywordData['AuthorId'].to_numpy(), keywordsUsed, len(authors))
+    authorData['BornYear'] = ''
+    authorData['Gender'] = ''
+
+    keywordData = summaryToOutput(keywords, 'Keyword')
+    keywordData['AuthorsUsed'] = splitIntoLists(keywordAuthorData['KeywordId'].to_numpy(), authorsUsed, len(keywords))
+
+    # sparse keyword x keyword matrix as rows of (RelatedId, Count), most co-occurring first
+    keywordPairs = partial['keywordPairs'].reset_index()
+    keywordPairs = pd.DataFrame({
+        'KeywordId': pd.Index(keywords.index).get_indexer(keywordPairs['Keyword']),
+        'RelatedId': pd.Index(keywords.index).get_indexer(keywordPairs['KeywordRelated']),
+        'Count': keywordPairs['Count'].to_numpy()
+    }).sort_values(['KeywordId', 'Count', 'RelatedId'], ascending=[True, False, True])
+
+    authorYears = authorData['Articles'].explode()
+    keywordYears = keywordData['Articles'].explode()
+
+    edgeTables = {
+        'authorsKeywords': pd.DataFrame({'AuthorId': authorKeywordData['AuthorId'].to_numpy(), 'KeywordId': authorKeywordData['KeywordId'].to_numpy(), 'Count': authorKeywordData['Count'].to_numpy()}).astype(authorKeywordColumns),
+        'authorsYears': pd.DataFrame({'AuthorId': authorYears.index.to_numpy(), 'Year': authorYears.to_numpy()}).astype(authorYearColumns),
+        'keywordsYears': pd.DataFrame({'KeywordId': keywordYears.index.to_numpy(), 'Year': keywordYears.to_numpy()}).astype(keywordYearColumns),
+        'keywordsKeywords': keywordPairs.reset_index(drop=True).astype(keywordKeywordColumns)
+    }
+
+    return authorData, keywordData, edgeTables
+
+
+def summaryToOutput(summary, nameColumn):
+    return pd.DataFrame({
+        nameColumn: summary.index.to_numpy(),
+        'ArticlesTotal': summary['ArticlesTotal'].to_numpy(),
+        'PagesTotal': summary['PagesTotal'].to_numpy(),
+        'EarliestArticle': summary['EarliestYear'].astype(str).to_numpy() + '-01-01',
+        'LatestArticle': summary['LatestYear'].astype(str).to_numpy() + '-12-01',
+        'Articles': summary['Years'].to_numpy(),
+        'ArticleMean': summary['YearSum'].to_numpy() / summary['ArticlesTotal'].to_numpy(),
+        'ActiveYears': (summary['LatestYear'] - summary['EarliestYear'] + 1).to_numpy()
+    })
+
+
+def getTokenSet(articleData, column):
+    tokens = articleData[column].str.split(';').explode().dropna()
+    return set(tokens[tokens != 'nan'])
+
+
+def selectRowsWithTokens(articleData, column, tokens):
+    exploded = articleData[column].str.split(';').explode()
+    return np.unique(exploded.index[exploded.isin(tokens)].to_numpy())
+
+
+def readState():
+    # articles and partial aggregates of the last run, None when a full run is needed (no state, or a
+    # state or text index written by an older version)
+    if not os.path.exists(statePath) or not os.path.exists(textIndexPath):
+        return None
+    state = pd.read_pickle(statePath)
+    if 'keywordPairs' not in state['partial'] or not set(stateColumns) <= set(state['articles'].columns) or state['articles']['PID'].duplicated().any():
+        return None
+    with np.load(textIndexPath) as textIndex:
+        if len(textIndex['lengths']) != len(state['articles']):
+            return None
+    return state
+
+
+def diffExport(oldArticles, chunks, processedFile):
+    # Compare the export with the articles of the last run one chunk at a time, looking them up by PID,
+    # and write the processed articles (without header). Returns the state columns of all articles,
+    # the (old rows, new rows) of the unchanged ones and all columns of the added or changed ones.
+    oldRows = pd.Index(oldArticles['PID'])
+    oldKeys = oldArticles[['LastUpdated', 'Name']].astype(object).fillna('').to_numpy()
+    newArticles = [pd.DataFrame(columns=stateColumns)]  # empty frames are only used when there are no chunks
+    keptOld, keptNew = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    added = [pd.DataFrame(columns=list(exportColumns) + ['Pages'])]
+    for chunk in chunks:
+        chunk.to_csv(processedFile, columns=processedColumns, header=False, index=False)
+        rows = oldRows.get_indexer(chunk['PID'])
+        unchanged = rows >= 0
+        unchanged[unchanged] = (oldKeys[rows[unchanged]] == chunk[['LastUpdated', 'Name']].astype(object).fillna('').to_numpy()[unchanged]).all(axis=1)  # Name changes when authors are reconciled
+        keptOld.append(rows[unchanged])
+        keptNew.append(chunk.index.to_numpy()[unchanged])
+        added.append(chunk[~unchanged])
+        newArticles.append(chunk[stateColumns])
+    return pd.concat(newArticles[1:] or newArticles), (np.concatenate(keptOld), np.concatenate(keptNew)), pd.concat(added[1:] or added)
+
+
+def updatePartial(state, newArticles, keptRows):
+    # Apply the articles added, changed (new LastUpdated) or deleted since the state was saved, given
+    # the unchanged articles found by diffExport. Returns the updated partial, the deleted or changed
+    # articles of the last run and the affected authors/keywords, or None if a full run is needed.
+    oldArticles = state['articles']
+    oldRows, newRows = keptRows
+    if newArticles['PID'].duplicated().any():
+        return None
+    if (np.diff(newRows[np.argsort(oldRows)]) < 0).any():  # export order changed, article order in lists would differ
+        return None
+
+    removedRows = np.ones(len(oldArticles), dtype=bool)
+    removedRows[oldRows] = False
+    addedRows = np.ones(len(newArticles), dtype=bool)
+    addedRows[newRows] = False
+    removed = oldArticles[removedRows]
+    added = newArticles[addedRows]
+    affectedAuthors = getTokenSet(removed, 'Name') | getTokenSet(added, 'Name')
+    affectedKeywords = getTokenSet(removed, 'Keywords') | getTokenSet(added, 'Keywords')
+
+    # recompute affected authors/keywords from all their articles (the state holds the columns needed)
+    rows = np.union1d(selectRowsWithTokens(newArticles, 'Name', affectedAuthors), selectRowsWithTokens(newArticles, 'Keywords', affectedKeywords))
+    fresh = aggregateArticles(newArticles.iloc[rows])
+
+    # unaffected aggregates are kept, with first appearances moved to their new article rows
+    movedRows = np.full(len(oldArticles), -1, dtype=np.int64)
+    movedRows[oldRows] = newRows
+
+    def moveFirstSeen(summary):
+        summary = summary.copy()
+        summary['FirstSeen'] = movedRows[summary['FirstSeen'].to_numpy() // rowFactor]*rowFactor + summary['FirstSeen'].to_numpy() % rowFactor
+        return summary
+
+    oldPartial = state['partial']
+    authors = oldPartial['authors'][~oldPartial['authors'].index.isin(affectedAuthors)]
+    keywords = oldPartial['keywords'][~oldPartial['keywords'].index.isin(affectedKeywords)]
+    pairs = oldPartial['pairs'][~(oldPartial['pairs'].index.get_level_values(0).isin(affectedAuthors) | oldPartial['pairs'].index.get_level_values(1).isin(affectedKeywords))]
+    freshPairs = fresh['pairs'][fresh['pairs'].index.get_level_values(0).isin(affectedAuthors) | fresh['pairs'].index.get_level_values(1).isin(affectedKeywords)]
+    keywordPairs = oldPartial['keywordPairs'][~(oldPartial['keywordPairs'].index.get_level_values(0).isin(affectedKeywords) | oldPartial['keywordPairs'].index.get_level_values(1).isin(affectedKeywords))]
+    freshKeywordPairs = fresh['keywordPairs'][fresh['keywordPairs'].index.get_level_values(0).isin(affectedKeywords) | fresh['keywordPairs'].index.get_level_values(1).isin(affectedKeywords)]
+
+    partial = {
+        'authors': pd.concat([moveFirstSeen(authors), fresh['authors'][fresh['authors'].index.isin(affectedAuthors)]]),
+        'keywords': pd.concat([moveFirstSeen(keywords), fresh['keywords'][fresh['keywords'].index.isin(affectedKeywords)]]),
+        'pairs': pd.concat([moveFirstSeen(pairs), freshPairs]),
+        'keywordPairs': pd.concat([keywordPairs, freshKeywordPairs])
+    }
+    print(len(added), 'articles added or changed,', len(removed), 'deleted or changed;', len(affectedAuthors), 'authors and', len(affectedKeywords), 'keywords updated')
+    return partial, removed, affectedAuthors, affectedKeywords
+
+
+def patchTextIndex(keptRows, added, articleCount):
+    # the text index of the last run with the deleted and changed articles taken out, the kept ones
+    # moved to their new rows and the added or changed articles indexed
+    with np.load(textIndexPath) as textIndex:
+        old = {name: textIndex[name] for name in textIndex.files}
+    movedRows = np.full(len(old['lengths']), -1, dtype=np.int64)
+    movedRows[keptRows[0]] = keptRows[1]
+    oldTermIds = np.repeat(np.arange(len(old['terms'])), np.diff(old['termStart']))
+    kept = movedRows[old['rows']] >= 0
+
+    postings, termCounts = getTextPostings(getArticleTexts(added))
+    newTerms = postings['Term'].to_numpy().astype(str)
+    terms = np.union1d(old['terms'], newTerms)
+    lengths = np.zeros(articleCount, dtype=np.int64)
+    lengths[keptRows[1]] = old['lengths'][keptRows[0]]
+    lengths[termCounts.index.to_numpy()] = termCounts.to_numpy()
+    np.savez_compressed(textIndexPath, **packTermPostings(
+        terms,
+        np.concatenate([np.searchsorted(terms, old['terms'])[oldTermIds[kept]], np.searchsorted(terms, newTerms)]),
+        np.concatenate([movedRows[old['rows'][kept]], postings['Row'].to_numpy()]),
+        np.concatenate([old['counts'][kept], postings['Count'].to_numpy()]),
+        lengths))
+
+
+def patchYearCubes(removed, added, firstYear, lastYear, authorData, keywordData):
+    # the year cubes of the last run (rows in the order of the author/keyword tables of the last run)
+    # with the deleted and changed articles subtracted and the added or changed ones added, None when
+    # there are no cubes matching those tables (or no articles in one of the runs)
+    if not os.path.exists(yearCubePath) or firstYear > lastYear:
+        return None
+    with np.load(yearCubePath) as cubeFile:
+        old = {name: cubeFile[name] for name in cubeFile.files}
+    if len(old['years']) == 0:
+        return None
+    oldFirst, oldLast = int(old['years'][0]), int(old['years'][-1])
+    unionFirst, unionLast = min(oldFirst, firstYear), max(oldLast, lastYear)  # years of both runs
+    cubes = {'years': np.arange(firstYear, lastYear+1).astype(np.int16)}
+    for entity, column, path, tokens in [('author', 'Name', 'fataburen_authors.csv', authorData['Name']), ('keyword', 'Keywords', 'fataburen_keywords.csv', keywordData['Keyword'])]:
+        oldTokens = pd.read_csv(path, usecols=[tokens.name], dtype=str, keep_default_na=False)[tokens.name]
+        if len(oldTokens) != len(old[entity + 'Articles']):
+            return None
+        oldIds = pd.Index(oldTokens).get_indexer(tokens)
+        removedCube = buildYearCube(removed, column, tokens, unionFirst, unionLast)
+        addedCube = buildYearCube(added, column, tokens, unionFirst, unionLast)
+        for position, (measure, dtype) in enumerate([('Articles', np.int32), ('Pages', np.float32)]):
+            cube = np.zeros((len(tokens), unionLast-unionFirst+1), dtype=np.float64)
+            cube[oldIds >= 0, oldFirst-unionFirst:oldLast-unionFirst+1] = old[entity + measure][oldIds[oldIds >= 0]]
+            cube += addedCube[position] - removedCube[position].astype(np.float64)
+            cubes[entity + measure] = cube[:, firstYear-unionFirst:lastYear-unionFirst+1].astype(dtype)
+    return cubes
+
+
+def getFigureKey(name, authorData, keywordData):
+    # fingerprint of the rows shown on the first page of a statistics view
+    rows = selectStatisticsRows(name, authorData, keywordData).iloc[:statisticsPageSize]
+    return hashlib.sha1(rows[[column for column in figureColumns if column in rows.columns]].to_csv(index=False).encode('utf-8')).hexdigest()
+
+
+def getArticleTexts(articleData):
+    # text searched on Explore: title, abstract and notes
+    return articleData['Title'].fillna('') + ' ' + articleData['Abstract'].fillna('') + ' ' + articleData['Notes'].fillna('')
+
+
+def getChunkPostings(chunk, vocabulary):
+    # text postings of a chunk with the terms as int32 ids, new terms added to vocabulary (term -> id),
+    # so the strings of the export's words are never kept, only one per distinct term
+    postings, termCounts = getTextPostings(getArticleTexts(chunk))
+    terms, codes = np.unique(postings['Term'].to_numpy().astype(str), return_inverse=True)
+    termIds = np.array([vocabulary.setdefault(term, len(vocabulary)) for term in terms], dtype=np.int32)
+    return {'termIds': termIds[codes], 'rows': postings['Row'].to_numpy().astype(np.int32), 'counts': postings['Count'].to_numpy().astype(np.int32)}, termCounts
+
+
+def writeTextIndex(shardPostings, termCounts):
+    # postings of the shards in article order, each with its own terms (ids into postings['terms'])
+    terms = np.unique(np.concatenate([postings['terms'] for postings in shardPostings]))
+    np.savez_compressed(textIndexPath, **packTermPostings(
+        terms,
+        np.concatenate([np.searchsorted(terms, postings['terms'])[postings['termIds']] for postings in shardPostings]),
+        np.concatenate([postings['rows'] for postings in shardPostings]),
+        np.concatenate([postings['counts'] for postings in shardPostings]),
+        pd.concat(termCounts).to_numpy()))
+
+
+def aggregateChunks(chunks, processedFile):
+    # write the processed articles (without header) and fold each chunk into the running aggregates;
+    # the aggregates (with a year list per author, keyword and pair), the state columns and the text
+    # postings (as term ids) of the whole export are kept until the end, so memory is linear in the
+    # number of articles, only the export table itself is never held in full
+    partial = None
+    stateArticles = [pd.DataFrame(columns=stateColumns)]  # empty frames are only used when there are no chunks
+    vocabulary = {}
+    postings = {'termIds': [np.array([], dtype=np.int32)], 'rows': [np.array([], dtype=np.int32)], 'counts': [np.array([], dtype=np.int32)]}
+    termCounts = [pd.Series(dtype='int64')]
+    for chunk in chunks:
+        chunk.to_csv(processedFile, columns=processedColumns, header=False, index=False)
+        chunkPartial = aggregateArticles(chunk)
+        partial = chunkPartial if partial is None else mergePartials([partial, chunkPartial])
+        stateArticles.append(chunk[stateColumns])
+        chunkPostings, chunkTermCounts = getChunkPostings(chunk, vocabulary)
+        for name, values in chunkPostings.items():
+            postings[name].append(values)
+        termCounts.append(chunkTermCounts)
+    postings = {name: np.concatenate(values) for name, values in postings.items()}
+    postings['terms'] = np.array(list(vocabulary), dtype=str)
+    return partial, pd.concat(stateArticles[1:] or stateArticles), postings, pd.concat(termCounts[1:] or termCounts)
+
+
+def processShard(path, shardPath, chunksize, aliases, nbnFilter):
+    # aggregates of one export file on its own, rows numbered from 0; the processed articles go to shardPath
+    with open(shardPath, 'w', newline='', encoding='utf-8') as shardFile:
+        return aggregateChunks(readExport([path], chunksize, aliases, nbnFilter), shardFile)
+
+
+def shiftShard(partial, stateArticles, postings, termCounts, offset):
+    # renumber the article rows of a shard to follow the offset articles of the shards before it
+    if partial is not None:
+        for part in ['authors', 'keywords', 'pairs']:
+            partial[part]['FirstSeen'] += offset*rowFactor
+    stateArticles.index += offset
+    postings['rows'] += offset
+    termCounts.index += offset
+
+
+def finishProcessing(shards, chunksize):
+    # merge the shards (in article order) and write the text index and the feather copy of the processed articles
+    partial = mergePartials([shard[0] for shard in shards if shard[0] is not None])
+    writeTextIndex([shard[2] for shard in shards], [shard[3] for shard in shards])
+    writeColumnarChunks(pd.read_csv(processedPath, usecols=list(articleColumns), dtype=articleColumns, chunksize=chunksize), processedPath, articleColumns)
+    return partial, pd.concat([shard[1] for shard in shards])
 
-from collections import Counter
 
-from functions import getTokenCountAsData, getTokenList
+def processChunks(chunks, chunksize):
+    with open(processedPath, 'w', newline='', encoding='utf-8') as processedFile:
+        pd.DataFrame(columns=processedColumns).to_csv(processedFile, index=False)
+        shard = aggregateChunks(chunks, processedFile)
+    return finishProcessing([shard], chunksize)
 
-articleData = pd.read_csv('fataburen_articles_diva.csv')
 
-articleData['Pages'] = articleData['EndPage']-articleData['StartPage']+1  # add pagecount as separate column in dataframe
+def processExports(paths, chunksize, aliases, jobs, nbnFilter):
+    # Export files are processed as shards in a process pool, each numbering its articles from 0.
+    # Shifting the rows by the articles of the previous files and merging the shards in file order
+    # gives the same output as one file holding all the exports.
+    if jobs <= 1 or len(paths) <= 1:
+        return processChunks(readExport(paths, chunksize, aliases, nbnFilter), chunksize)
 
-articleData = articleData[articleData['NBN'].str.contains('nordiskamuseet')]  # clean data by removing duplicate articles added by other institutions
+    shardPaths = [processedPath + '.' + str(position) for position in range(len(paths))]
+    shards = mapShards(processShard, [(path, shardPath, chunksize, aliases, nbnFilter) for path, shardPath in zip(paths, shardPaths)], jobs)
+    offset = 0
+    for shard in shards:
+        shiftShard(*shard, offset)
+        offset += len(shard[1])
 
-articleData['Name'] = articleData['Name'].str.replace(' (Nordiska museet [877150])', '', regex=False)
-articleData['Name'] = articleData['Name'].str.replace(' (Stiftelsen Nordiska museet)', '', regex=False)
+    with open(processedPath, 'w', newline='', encoding='utf-8') as processedFile:
+        pd.DataFrame(columns=processedColumns).to_csv(processedFile, index=False)
+        for shardPath in shardPaths:
+            with open(shardPath, newline='', encoding='utf-8') as shardFile:
+                shutil.copyfileobj(shardFile, processedFile)
+            os.remove(shardPath)
+    return finishProcessing(shards, chunksize)
 
 
-keywordsData = getTokenCountAsData(articleData, 'Keywords', 'Keywords', [])
-authorsData = getTokenCountAsData(articleData, 'Name', 'Authors', [])
+def writeOutputs(authorData, keywordData, edgeTables, outputs=allOutputs, chunksize=50000, changes=None, figureKeys=None):
+    # changes are the (deleted or changed articles of the last run, added or changed articles, first
+    # year, last year) of an incremental run, used to patch the year cubes instead of rebuilding them;
+    # figureKeys (updated here) are the getFigureKey of the statistics figures written before
 
-unique_keywords = keywordsData['Keywords'].unique()
-unique_authors = authorsData['Authors'].unique()
+    # Per author and keyword article counts and page sums by year, read by the app's Explore and
+    # Trends views instead of exploding the articles at startup (patched before the tables of the
+    # last run are replaced, saved after them: the app only reads cubes newer than the tables)
 
+    cubes = None
+    if 'yearCubes' in outputs:
+        cubes = None if changes is None else patchYearCubes(*changes, authorData, keywordData)
+        if cubes is None:
+            firstYear, lastYear = getYearSpan(pd.read_csv(processedPath, usecols=['Year'])['Year'])
+            chunks = pd.read_csv(processedPath, usecols=['Name', 'Keywords', 'Pages', 'Year'], dtype={'Name': str, 'Keywords': str}, chunksize=chunksize)
+            cubes = buildYearCubes(chunks, authorData['Name'], keywordData['Keyword'], firstYear, lastYear)
 
-articleData.to_csv('fataburen_articles_diva_processed.csv', columns=['Name', 'PID', 'Title', 'Keywords', 'StartPage', 'EndPage', 'Pages', 'Year', 'NBN'], index=False)
+    if 'authors' in outputs:
+        authorData.to_csv('fataburen_authors.csv', index=False)
+        writeColumnarData(authorData, 'fataburen_authors.csv', authorColumns)
 
-# authorData = pd.DataFrame(columns=['Name','ArticlesTotal','PagesTotal','EarliestArticle','LatestArticle','KeywordsUsed','BornYear','Gender'])
+    if 'keywords' in outputs:
+        keywordData.to_csv('fataburen_keywords.csv', index=False)
+        writeColumnarData(keywordData, 'fataburen_keywords.csv', keywordColumns)
 
-authorData = {}
-keywordData = {}
+    # Normalized edge tables, ids are row positions in the author/keyword csv files
 
-for author in unique_authors:
-    authorData[author] = {'Name': author, 'ArticlesTotal': 0, 'PagesTotal': 0, 'EarliestArticle': '9999', 'LatestArticle': '1', 'Articles': [], 'ArticleMean': '', 'ActiveYears': 0, 'KeywordsUsed': [], 'BornYear': '', 'Gender': ''}
+    edgeFiles = [
+        ('authorsKeywords', authorKeywordColumns, 'fataburen_authors_keywords.csv'),
+        ('authorsYears', authorYearColumns, 'fataburen_authors_years.csv'),
+        ('keywordsYears', keywordYearColumns, 'fataburen_keywords_years.csv'),
+        ('keywordsKeywords', keywordKeywordColumns, 'fataburen_keywords_keywords.csv')
+    ]
 
-for keyword in unique_keywords:
-    keywordData[keyword] = {'Keyword': keyword, 'ArticlesTotal': 0, 'PagesTotal': 0, 'EarliestArticle': '9999', 'LatestArticle': '1', 'Articles': [], 'ArticleMean': '', 'ActiveYears': 0, 'AuthorsUsed': []}
+    for table, columns, path in edgeFiles:
+        if table in outputs:
+            edgeTables[table].to_csv(path, index=False)
+            writeColumnarData(edgeTables[table], path, columns)
 
+    if cubes is not None:
+        np.savez_compressed(yearCubePath, **cubes)
 
-for row in articleData.itertuples():
-    authorList = getTokenList(row[2])
-    keywordList = getTokenList(str(row[34]))
-    for author in authorList:
-        authorData[author]['ArticlesTotal'] = authorData[author]['ArticlesTotal'] + 1
-        if not math.isnan(row[18]):  # If page count exists
-            authorData[author]['PagesTotal'] = authorData[author]['PagesTotal'] + row[18]
-        if int(row[16]) < int(authorData[author]['EarliestArticle']):
-            authorData[author]['EarliestArticle'] = row[16]
-        if int(row[16]) > int(authorData[author]['LatestArticle']):
-            authorData[author]['LatestArticle'] = row[16]
-        authorData[author]['Articles'].append(float(row[16]))  # add article year to list
-        for keyword in keywordList:
-            if not keyword == 'nan':
-                authorData[author]['KeywordsUsed'].append(keyword)
+    # Pre-serialized first pages of the statistics views, served by the app without rebuilding them
+    # (only when the rows they show have changed, else only marked as newer than the rewritten table)
 
-    for keyword in keywordList:
-        if not keyword == 'nan':
-            keywordData[keyword]['ArticlesTotal'] = keywordData[keyword]['ArticlesTotal'] + 1
-            if not math.isnan(row[18]):  # If page count exists
-                keywordData[keyword]['PagesTotal'] = keywordData[keyword]['PagesTotal'] + row[18]
-            if int(row[16]) < int(keywordData[keyword]['EarliestArticle']):
-                keywordData[keyword]['EarliestArticle'] = row[16]
-            if int(row[16]) > int(keywordData[keyword]['LatestArticle']):
-                keywordData[keyword]['LatestArticle'] = row[16]
-            keywordData[keyword]['Articles'].append(float(row[16]))  # add article year to list
-            for author in authorList:
-                keywordData[keyword]['AuthorsUsed'].append(author)
+    figureKeys = {} if figureKeys is None else figureKeys
+    for name in statisticsViews:
+        if name.split('-')[0] in outputs:
+            figureKey = getFigureKey(name, authorData, keywordData)
+            if figureKeys.get(name) != figureKey or not os.path.exists(getFigurePath(name)):
+                with open(getFigurePath(name), 'w', encoding='utf-8') as figureFile:
+                    figureFile.write(buildStatisticsFigure(name, authorData, keywordData).to_json())
+            else:
+                os.utime(getFigurePath(name))
+            figureKeys[name] = figureKey
+    return figureKeys
 
-authorDataAsList = []
 
-for item in authorData.items():
-    item[1]['ActiveYears'] = int(item[1]['LatestArticle']) - int(item[1]['EarliestArticle']) + 1
-    item[1]['EarliestArticle'] = str(item[1]['EarliestArticle'])+'-01-01'
-    item[1]['LatestArticle'] = str(item[1]['LatestArticle'])+'-12-01'
-    keywordsUsed = Counter(item[1]['KeywordsUsed']).most_common()
-    item[1]['KeywordsUsed'] = keywordsUsed
-    item[1]['ArticleMean'] = statistics.mean(item[1]['Articles'])
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepare a DiVA csv export for the app.')
+    parser.add_argument('export', nargs='*', default=['fataburen_articles_diva.csv'], help='DiVA exports (format=csvall), files or directories of csv files, in article order')
+    parser.add_argument('--incremental', action='store_true', help='only apply articles added, changed or deleted since the last run')
+    parser.add_argument('--chunksize', type=int, default=50000, help='number of export rows read at a time')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of export files processed in parallel')
+    parser.add_argument('--no-reconcile', dest='reconcile', action='store_false', help='only apply the saved author aliases (' + aliasPath + '), without looking for new name variants')
+    parser.add_argument('--nbn', help='keep only the articles whose NBN contains this text, \'\' keeps all (default: "nbnFilter" of ' + settingsPath + ' in the output directory)')
+    parser.add_argument('--directory', help='write the prepared files to this directory (a corpus for the app) instead of the current one')
+    args = parser.parse_args()
 
-    authorDataAsList.append(item[1])
+    if args.directory:
+        args.export = [os.path.abspath(export) for export in args.export]
+        os.makedirs(args.directory, exist_ok=True)
+        os.chdir(args.directory)
 
-authorDataPanda = pd.DataFrame(authorDataAsList)
+    paths = getExportPaths(args.export)
+    if args.nbn is None:
+        args.nbn = readCorpusSettings('.').get('nbnFilter', '')
+    aliases = readAuthorAliases(paths, args.chunksize, args.reconcile, args.jobs, args.nbn)
 
-print(authorDataPanda.head())
+    # An incremental run compares the export with the state one chunk at a time, writing the processed
+    # articles to a new file, and then patches the text index and year cubes with the changed articles
 
-keywordDataAsList = []
+    state = readState() if args.incremental else None
+    update = None
+    if state is not None:
+        with open(processedPath + '.new', 'w', newline='', encoding='utf-8') as processedFile:
+            pd.DataFrame(columns=processedColumns).to_csv(processedFile, index=False)
+            stateArticles, keptRows, addedArticles = diffExport(state['articles'], readExport(paths, args.chunksize, aliases, args.nbn), processedFile)
+        update = updatePartial(state, stateArticles, keptRows)
 
-for item in keywordData.items():
-    item[1]['ActiveYears'] = int(item[1]['LatestArticle']) - int(item[1]['EarliestArticle']) + 1
-    item[1]['EarliestArticle'] = str(item[1]['EarliestArticle'])+'-01-01'
-    item[1]['LatestArticle'] = str(item[1]['LatestArticle'])+'-12-01'
-    authorsUsed = Counter(item[1]['AuthorsUsed']).most_common()
-    item[1]['AuthorsUsed'] = authorsUsed
-    item[1]['ArticleMean'] = statistics.mean(item[1]['Articles'])
+    if update is None:
+        if args.incremental:
+            print('Cannot update incrementally, processing all articles')
+        partial, stateArticles = processExports(paths, args.chunksize, aliases, args.jobs, args.nbn)
+        outputs = allOutputs - {'articles'}  # already written by processExports
+        changes = None
+        figureKeys = {}
+    else:
+        partial, removedArticles, affectedAuthors, affectedKeywords = update
+        figureKeys = state.get('figures', {})
+        outputs = set()
+        if len(removedArticles) or len(addedArticles):
+            outputs = {'articles'}
+            os.replace(processedPath + '.new', processedPath)
+            writeColumnarChunks(pd.read_csv(processedPath, usecols=list(articleColumns), dtype=articleColumns, chunksize=args.chunksize), processedPath, articleColumns)
+            patchTextIndex(keptRows, addedArticles, len(stateArticles))
+        if affectedAuthors or affectedKeywords:
+            outputs |= {'authorsKeywords', 'yearCubes'}
+        if affectedAuthors:
+            outputs |= {'authors', 'authorsYears'}
+        if affectedKeywords:
+            outputs |= {'keywords', 'keywordsYears', 'keywordsKeywords'}
+        years = getYearSpan(stateArticles['Year'])
+        if years != getYearSpan(state['articles']['Year']):
+            outputs.add('yearCubes')
+        changes = (removedArticles, addedArticles, years[0], years[1])
 
-    keywordDataAsList.append(item[1])
+    if os.path.exists(processedPath + '.new'):
+        os.remove(processedPath + '.new')
 
-keywordDataPanda = pd.DataFrame(keywordDataAsList)
+    if outputs - {'articles'}:
+        authorDataPanda, keywordDataPanda, edgeTables = finalizeAggregates(partial)
 
-print(keywordDataPanda.head())
+        print(authorDataPanda.head())
+        print(keywordDataPanda.head())
 
-authorDataPanda.to_csv('fataburen_authors.csv', index=False)
+        figureKeys = writeOutputs(authorDataPanda, keywordDataPanda, edgeTables, outputs, args.chunksize, changes, figureKeys)
 
-keywordDataPanda.to_csv('fataburen_keywords.csv', index=False)
+    if outputs:
+        pd.to_pickle({'articles': stateArticles, 'partial': partial, 'figures': figureKeys}, statePath)
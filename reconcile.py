@@ -0,0 +1,212 @@
+import os
+import re
+
+import pandas as pd
+
+from functions import normalizeText
+
+# Author reconciliation for prepare_data.py. Author strings ("Surname, Given names", after removing
+# affiliations) that are spelling or initial variants of each other are clustered and mapped to
+# one canonical name. Names are only compared within blocks sharing a key (surname + first initial,
+# or a sound-alike surname key + the same given names), never all pairs.
+#
+# Sound-alike surnames are common namesakes as often as spelling variants (Carlsson/Karlsson,
+# Berg/Bergh, Lindqvist/Lindkvist), so the key only picks the names to compare: two of them are
+# merged when they share a keyword, and the other pairs are written to reviewPath for a curator to
+# merge in the aliases by hand. Being active in the same years is no evidence, as namesakes of one
+# generation are the common case.
+#
+# The mapping of every author string seen is saved in aliasPath and applied first on later runs,
+# so canonical names stay the same; new strings can only join an existing author or start a new
+# one. Edit the Author column to fix a mapping, e.g. set it to the alias itself to split a wrong merge.
+
+aliasPath = 'fataburen_author_aliases.csv'
+reviewPath = 'fataburen_author_review.csv'
+anonymousSurnames = {'nn', 'anonym', 'okand'}  # never merged with anything but exact variants
+soundAlikes = [('ck', 'k'), ('ch', 'k'), ('ph', 'f'), ('qu', 'kv'), ('th', 't'), ('dh', 'd'), ('gh', 'g'), ('c', 'k'), ('q', 'k'), ('w', 'v'), ('z', 's'), ('x', 'ks')]
+
+
+def stripAffiliations(names):
+    # "Surname, Given (Organisation [id]; Other organisation)" -> "Surname, Given"
+    return names.str.replace(r'\s*\([^()]*\)', '', regex=True)
+
+
+def splitName(name):
+    # -> normalized surname, tuple of normalized given names (single letters are initials)
+    surname, _, given = normalizeText(name).partition(',')
+    return ' '.join(re.findall(r'[^\W\d_]+', surname)), tuple(re.findall(r'[^\W\d_]+', given))
+
+
+def getPhoneticKey(surname):
+    # rough sound-alike key for surname spellings, e.g. Ericsson/Eriksson, Pettersson/Petersson
+    key = surname.replace(' ', '')
+    for spelling, sound in soundAlikes:
+        key = key.replace(spelling, sound)
+    return re.sub(r'(.)\1+', r'\1', key)
+
+
+def getSpecificity(given):
+    return (sum(len(name) > 1 for name in given), sum(len(name) for name in given))
+
+
+def matchesName(name, otherName):
+    return name == otherName or (len(name) == 1 and otherName.startswith(name))
+
+
+def isCompatible(given, otherGiven):
+    # given may be a shorter form of otherGiven: same first name (or its initial), and the
+    # remaining names or initials found in the same order, e.g. "N E" and "Nils" in "Nils Edvard"
+    if not given or not otherGiven or not matchesName(given[0], otherGiven[0]):
+        return False
+    position = 1
+    for name in given[1:]:
+        while position < len(otherGiven) and not matchesName(name, otherGiven[position]):
+            position += 1
+        if position == len(otherGiven):
+            return False
+        position += 1
+    return True
+
+
+class AuthorClusters:
+    # union-find over author strings; clusters holding a saved canonical name (pinned) are never merged
+
+    def __init__(self, names):
+        self.parent = {name: name for name in names}
+        self.pinned = {}  # root -> canonical name
+
+    def find(self, name):
+        root = name
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[name] != root:  # path compression
+            self.parent[name], name = root, self.parent[name]
+        return root
+
+    def union(self, name, otherName, force=False):
+        root, otherRoot = self.find(name), self.find(otherName)
+        if root == otherRoot or (not force and root in self.pinned and otherRoot in self.pinned):
+            return
+        self.parent[otherRoot] = root
+        if otherRoot in self.pinned:
+            self.pinned[root] = self.pinned.pop(otherRoot)
+
+
+def readAliases(path=aliasPath):
+    if not os.path.exists(path):
+        return {}
+    aliases = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return dict(zip(aliases['Alias'], aliases['Author']))
+
+
+def writeAliases(aliases, path=aliasPath):
+    aliases = pd.DataFrame({'Alias': list(aliases.keys()), 'Author': list(aliases.values())})
+    aliases.sort_values(['Author', 'Alias']).to_csv(path, index=False)
+
+
+def writeReview(candidates, path=reviewPath):
+    pd.DataFrame(candidates, columns=['Author', 'SoundAlike']).to_csv(path, index=False)
+
+
+def countAuthorNames(articleData):
+    # articles per author string (affiliations already removed), and the (author string, keyword)
+    # pairs, the evidence for merging sound-alike surnames
+    names = articleData['Name'].str.split(';').explode().str.strip()
+    names = names[names.notna() & (names != 'nan') & (names != '')]
+    keywords = articleData['Keywords'].str.split(';').explode().str.strip()
+    keywords = keywords[keywords.notna() & (keywords != '')]
+    nameKeywords = pd.merge(pd.DataFrame({'Name': names.to_numpy(), 'Row': names.index}), pd.DataFrame({'Keyword': keywords.to_numpy(), 'Row': keywords.index}), on='Row')
+    return names.value_counts(), nameKeywords[['Name', 'Keyword']].drop_duplicates()
+
+
+def mergeAuthorCounts(authorCounts):
+    # countAuthorNames of several chunks or export files -> the same for all of them
+    nameCounts = pd.concat([counts[0] for counts in authorCounts]).groupby(level=0).sum()
+    return nameCounts, pd.concat([counts[1] for counts in authorCounts]).drop_duplicates()
+
+
+def hasCoEvidence(keywordSets, names, otherNames):
+    # whether the author strings of two sound-alike forms share a keyword
+    keywords = set().union(*(keywordSets.get(name, set()) for name in names))
+    return any(keywords & keywordSets.get(name, set()) for name in otherNames)
+
+
+def reconcileAuthors(nameCounts, nameKeywords, aliases):
+    # author string -> canonical name for all names in nameCounts (see countAuthorNames) and aliases,
+    # and the (canonical name, canonical name) pairs of sound-alike authors left for review
+    names = sorted(set(nameCounts.index) | set(aliases) | set(aliases.values()))
+    clusters = AuthorClusters(names)
+    for alias, author in aliases.items():
+        clusters.union(author, alias, force=True)
+    for author in set(aliases.values()):
+        clusters.pinned[clusters.find(author)] = author
+
+    splitNames = {name: splitName(name) for name in names}
+    forms = {}  # (surname, given names) -> author strings
+    for name in names:
+        forms.setdefault(splitNames[name], []).append(name)
+
+    # the same name up to case, accents and punctuation
+    for variants in forms.values():
+        for variant in variants[1:]:
+            clusters.union(variants[0], variant)
+
+    # sound-alike surnames with the same given names, when they share a keyword
+    phoneticBlocks = {}
+    for surname, given in forms:
+        if surname not in anonymousSurnames and getSpecificity(given)[0] > 0:
+            phoneticBlocks.setdefault((getPhoneticKey(surname), given), []).append((surname, given))
+    phoneticBlocks = [block for block in phoneticBlocks.values() if len(block) > 1]
+    blockNames = [name for block in phoneticBlocks for form in block for name in forms[form]]
+    blockKeywords = nameKeywords[nameKeywords['Name'].isin(blockNames)]
+    keywordSets = {name: set(keywords) for name, keywords in blockKeywords.groupby('Name')['Keyword']}
+    soundAlikePairs = []
+    for block in phoneticBlocks:
+        for position, form in enumerate(block):
+            for otherForm in block[:position]:
+                if hasCoEvidence(keywordSets, forms[otherForm], forms[form]):
+                    clusters.union(forms[otherForm][0], forms[form][0])
+                else:
+                    soundAlikePairs.append((forms[otherForm][0], forms[form][0]))
+
+    # initials and left out given names, most specific forms first so that a short form only
+    # joins a cluster when all the longer forms it fits belong to the same author
+    initialBlocks = {}
+    for surname, given in forms:
+        if surname not in anonymousSurnames and given:
+            initialBlocks.setdefault((surname, given[0][0]), []).append(given)
+    for (surname, _), block in initialBlocks.items():
+        block.sort(key=getSpecificity, reverse=True)
+        for position, given in enumerate(block):
+            roots = set(clusters.find(forms[(surname, otherGiven)][0]) for otherGiven in block[:position] if isCompatible(given, otherGiven))
+            if len(roots) == 1:
+                clusters.union(roots.pop(), forms[(surname, given)][0])
+
+    # canonical name: the saved one, or else the variant with most articles (then the most complete)
+    members = {}
+    for name in names:
+        members.setdefault(clusters.find(name), []).append(name)
+    mapping = {}
+    for root, cluster in members.items():
+        canonical = clusters.pinned.get(root)
+        if canonical is None:
+            canonical = max(cluster, key=lambda name: (nameCounts.get(name, 0), getSpecificity(splitNames[name][1]), len(name)))
+        for name in cluster:
+            mapping[name] = canonical
+    candidates = sorted(set((mapping[name], mapping[otherName]) for name, otherName in soundAlikePairs if mapping[name] != mapping[otherName]))
+    return mapping, candidates
+
+
+def applyAliases(names, aliases):
+    # ;-separated author strings -> canonical names, each author kept once per article
+    tokens = names[names.notna()].str.split(';').explode()
+    canonical = tokens.str.strip()
+    canonical = canonical.map(aliases).fillna(canonical)
+    changedRows = tokens.index[(canonical != tokens).to_numpy()].unique()  # only these articles are joined again
+    if len(changedRows) == 0:
+        return names
+    canonical = canonical[canonical.index.isin(changedRows)]
+    canonical = canonical[~pd.DataFrame({'Row': canonical.index, 'Name': canonical.to_numpy()}).duplicated().to_numpy()]
+    names = names.copy()
+    names.loc[changedRows] = canonical.groupby(level=0, sort=False).agg(';'.join)
+    return names
@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+from harvest_data import countRows, harvest, manifestName
+from harvest_stub import readExportRows, startStubServer
+
+# Offline checks of harvest_data.py against harvest_stub.py serving the committed export:
+# python -m pytest test_harvest.py (or python test_harvest.py)
+
+exportPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fataburen_articles_diva.csv')
+
+
+def runHarvest(directory, pageSizes=[500], **options):
+    # harvest once per page size from one stub server; returns harvest() of the last run and the requests
+    serverOptions = {name: options.pop(name) for name in ['ignoreOffset', 'failures', 'etags'] if name in options}
+    server, url = startStubServer(exportPath, **serverOptions)
+    try:
+        for pageSize in pageSizes:
+            result = harvest(url, directory, pageSize, 4, 'startRow', backoff=0, timeout=10, **options)
+        return result, server.requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def getPageFiles(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith('page_'))
+
+
+def readHarvestedRows(directory):
+    rows = []
+    for name in getPageFiles(directory):
+        rows += readExportRows(os.path.join(directory, name))[1]
+    return rows
+
+
+def test_harvest_pages():
+    with tempfile.TemporaryDirectory() as directory:
+        (changes, complete), _ = runHarvest(directory)
+        assert complete
+        assert getPageFiles(directory) == ['page_00000.csv', 'page_00001.csv', 'page_00002.csv', 'page_00003.csv']
+        assert readHarvestedRows(directory) == readExportRows(exportPath)[1]
+        assert changes == 4
+        assert os.path.exists(os.path.join(directory, manifestName))
+
+
+def test_unchanged_pages_are_not_downloaded_again():
+    with tempfile.TemporaryDirectory() as directory:
+        (changes, complete), _ = runHarvest(directory, [500, 500])
+        assert complete and changes == 0
+        assert readHarvestedRows(directory) == readExportRows(exportPath)[1]
+
+
+def test_server_ignoring_offset():
+    # every page is the first one: stop at the first repeated page instead of harvesting forever
+    for etags in [True, False]:
+        with tempfile.TemporaryDirectory() as directory:
+            (_, complete), requests = runHarvest(directory, ignoreOffset=True, etags=etags)
+            assert not complete
+            assert getPageFiles(directory) == ['page_00000.csv']
+            assert countRows(os.path.join(directory, 'page_00000.csv')) == 500
+            assert len(requests) < 10
+
+
+def test_max_pages():
+    with tempfile.TemporaryDirectory() as directory:
+        (_, complete), requests = runHarvest(directory, [100], maxPages=3)
+        assert not complete
+        assert getPageFiles(directory) == ['page_00000.csv', 'page_00001.csv', 'page_00002.csv']
+        assert len(requests) == 3
+
+
+def test_retries():
+    with tempfile.TemporaryDirectory() as directory:
+        _, requests = runHarvest(directory, failures=2)
+        assert readHarvestedRows(directory) == readExportRows(exportPath)[1]
+        assert len(requests) >= 4 + 2  # the four pages and the two failed requests
+
+
+def test_pages_of_a_larger_harvest_are_removed():
+    with tempfile.TemporaryDirectory() as directory:
+        (changes, complete), _ = runHarvest(directory, [200, 1000])
+        assert complete
+        assert getPageFiles(directory) == ['page_00000.csv', 'page_00001.csv']
+        assert readHarvestedRows(directory) == readExportRows(exportPath)[1]
+        assert changes > 0
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')